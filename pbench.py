@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+# Throughput benchmark for pdis, run on synthetic code files from pgen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Each corpus is generated from a fixed seed, so every run disassembles
+# the same code.  The disassembly of each segment is split into the same
+# phases dis_code_segment goes through:
+#
+#   load     reading the segment out of the code file into memory
+#   pass_1   decoding the procedures (dis_seg with no output)
+#   pass_2   walking memory and producing the listing records
+#   render   formatting the records as text and as JSON lines
+#
+# Each phase is timed over several repetitions and the fastest is kept.
+# The results can be saved as a baseline, and later runs compared against
+# it, failing if any phase has become slower than the tolerance allows.
+#
+# Raw throughput depends on the machine, so each run also times a fixed
+# calibration workload of plain Python, the kind of work the disassembler
+# does, that doesn't use pdis.  Runs are compared by throughput scaled by
+# the calibration time, which carries over between machines much better
+# than raw throughput.  The reference baseline, bench_baseline.json, is
+# kept in the repository and used by --check unless --baseline names
+# another, such as one saved on the machine that runs the checks.
+
+import argparse
+import gc
+import io
+import json
+import os
+import random
+import sys
+import time
+
+import pdis
+import pgen
+
+corpora = { 'default': (1, pgen.default_params._replace(segments = 16, procs = 20)),
+            'large':   (2, pgen.default_params._replace(segments = 16, procs = 30, insts = 400)),
+            'branchy': (3, pgen.default_params._replace(segments = 16, procs = 20,
+                                                        branch_density = 0.35, case_density = 0.1)) }
+
+phases = ['load', 'pass_1', 'pass_2', 'render']
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+calibration_data = bytes(random.Random(0).randrange(256) for i in range(4096))
+
+# A fixed workload of byte indexing, tuple and dictionary handling and
+# string formatting, returning its time in seconds.
+def calibrate():
+    data = calibration_data
+    t0 = time.perf_counter()
+    table = {}
+    lines = []
+    for n in range(100):
+        for i in range(0, len(data) - 2, 3):
+            key = (data[i], data[i + 1] & 0x7f)
+            count = table.get(key, 0)
+            table[key] = count + 1
+            if data[i + 2] < 64:
+                lines.append('%04x: %02x %02x %-8s %d' % (i, key[0], key[1], 'op', count))
+    return time.perf_counter() - t0
+
+# A renderer that keeps the records, so that pass 2 can be timed
+# separately from the formatting of its output.
+class RecordingRenderer(pdis.Renderer):
+    def __init__(self, file = None, header = True):
+        pdis.Renderer.__init__(self, file, header)
+        self.records = []
+
+    def record(self, rec):
+        self.records.append(rec)
+
+    def blank(self):
+        self.records.append(None)
+
+def replay(records, renderer):
+    for rec in records:
+        if rec is None:
+            renderer.blank()
+        else:
+            renderer.record(rec)
+    renderer.flush()
+
+# Disassemble each segment of codefile once, returning the time spent in
+# each phase, and the number of instructions decoded.
+def run_once(codefile):
+    times = dict.fromkeys(phases, 0.0)
+    insts = 0
+    dis = pdis.Disassembler(log = io.StringIO())
+    for si in codefile.code_segments():
+        seg_name = pdis.seg_info_name(si)
+        t0 = time.perf_counter()
+        dis.mem_init()
+        with codefile.segment_data(si) as data:
+            dis.load_words(data)
+        t1 = time.perf_counter()
+        dis.dis_seg(si.segnum, 0, si.length, seg_name, None)
+        t2 = time.perf_counter()
+        out = RecordingRenderer()
+        dis.pass_2(out)
+        t3 = time.perf_counter()
+        replay(out.records, pdis.TextRenderer(io.StringIO(), header = False))
+        replay(out.records, pdis.JsonLinesRenderer(io.StringIO(), header = False))
+        t4 = time.perf_counter()
+        times['load']   += t1 - t0
+        times['pass_1'] += t2 - t1
+        times['pass_2'] += t3 - t2
+        times['render'] += t4 - t3
+        insts += sum(len(p) for p in dis.decoded_procs.values())
+    return times, insts
+
+def bench_corpus(name, repeat):
+    seed, params = corpora[name]
+    codefile = pdis.CodeFile(pgen.gen_codefile(random.Random(seed), params))
+    size = sum(si.length * 2 for si in codefile.code_segments())
+    # the first run only warms up the caches, and as with timeit, the
+    # garbage collector is kept from running during the timed runs
+    # The calibration workload is run before and after each repetition,
+    # so that both see the machine in much the same state, and the best
+    # score of each phase, its throughput scaled by the calibration
+    # time, is kept along with its fastest time.
+    run_once(codefile)
+    best = dict.fromkeys(phases)
+    best_score = dict.fromkeys(phases, 0.0)
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            c = calibrate()
+            times, insts = run_once(codefile)
+            c = (c + calibrate()) / 2
+            for phase in phases:
+                if best[phase] is None or times[phase] < best[phase]:
+                    best[phase] = times[phase]
+                best_score[phase] = max(best_score[phase], insts / times[phase] * c)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return { phase: { 'seconds':    best[phase],
+                      'inst_per_s': insts / best[phase],
+                      'mb_per_s':   size / best[phase] / 1e6,
+                      'score':      best_score[phase] }
+             for phase in phases }, insts, size
+
+def score(results, name, phase):
+    return results[name]['phases'][phase]['score']
+
+def report(results, baseline, file):
+    print('%-8s %-7s %10s %12s %9s %9s' % ('corpus', 'phase', 'seconds', 'inst/s', 'MB/s', 'baseline'), file = file)
+    for name in sorted(results):
+        for phase in phases:
+            r = results[name]['phases'][phase]
+            ratio = ''
+            if baseline is not None and name in baseline:
+                ratio = '%8.2fx' % (score(results, name, phase) / score(baseline, name, phase))
+            print('%-8s %-7s %10.4f %12.0f %9.3f %9s' % (name, phase, r['seconds'], r['inst_per_s'], r['mb_per_s'], ratio), file = file)
+        print('%-8s %d instructions, %d bytes of code' % (name, results[name]['instructions'], results[name]['bytes']), file = file)
+
+# Returns a list of the phases slower than the baseline by more than
+# tolerance, as a fraction of the baseline's scaled throughput.
+def regressions(results, baseline, tolerance):
+    slow = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for phase in phases:
+            now = score(results, name, phase)
+            then = score(baseline, name, phase)
+            if now < then * (1 - tolerance):
+                slow.append('%s %s: %.2f of the baseline' % (name, phase, now / then))
+    return slow
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'pdis throughput benchmark')
+    parser.add_argument('-c', '--corpus', action = 'append', choices = sorted(corpora), help = 'corpus to run; may be repeated (default: all)')
+    parser.add_argument('-r', '--repeat', type = int, default = 5, help = 'repetitions of each corpus, of which the fastest is kept (default: %(default)s)')
+    parser.add_argument('--baseline', default = default_baseline, help = 'baseline file (default: the reference baseline, %(default)s)')
+    parser.add_argument('--save', action = 'store_true', help = 'save the results as the baseline')
+    parser.add_argument('--check', action = 'store_true', help = 'exit with an error if any phase is slower than the baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'fraction of the baseline throughput that may be lost before --check fails (default: %(default)s)')
+    parser.add_argument('-o', '--output', type = argparse.FileType('w'), default = sys.stdout, help = 'report file (default: stdout)')
+    args = parser.parse_args()
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if any('score' not in p for r in baseline.values() for p in r['phases'].values()):
+            parser.error('%s is a baseline without calibration; save it again' % args.baseline)
+    elif args.check:
+        parser.error('no baseline file %s' % args.baseline)
+
+    results = {}
+    for name in args.corpus or sorted(corpora):
+        times, insts, size = bench_corpus(name, args.repeat)
+        results[name] = { 'phases': times, 'instructions': insts, 'bytes': size }
+
+    report(results, baseline, args.output)
+
+    if args.save:
+        saved = dict(baseline or {})
+        saved.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(saved, f, indent = 1, sort_keys = True)
+            f.write('\n')
+
+    if args.check:
+        slow = regressions(results, baseline, args.tolerance)
+        for s in slow:
+            print('regression: ' + s, file = sys.stderr)
+        if slow:
+            sys.exit(1)
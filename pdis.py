@@ -17,32 +17,95 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import array
 import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
+import difflib
+import fnmatch
+import glob
+import hashlib
+import io
 import itertools
+import json
+import mmap
+import os
+import pickle
+import pstats
+import struct
 import sys
-
-#from pyImageDisk import disk, filesystem
+import time
+import traceback
+import tracemalloc
 
 nil = 0xfc00
 
-image_base = 0
-image_len = 0
-mem = None
-memusage = None
-labels = None
-
-def mem_init():
-    global image_base, image_len, mem, memusage, labels
-    image_base = 0
-    image_len = 0
-    mem = [0] * 65536
-    memusage = [None] * 65536
-    labels = [None] * 131072
-
-def add_label(seg_base, byte_offset, label):
-    global labels
-    labels[seg_base * 2 + byte_offset] = label
+# Memory images are stored as little-endian bytes, which the instruction
+# decoder indexes directly, and words is a 16-bit word view of the same
+# buffer.  On a big-endian host the words have to be byte swapped, so
+# words is a separate array that is rebuilt whenever memory is loaded.
+def word_view(b):
+    if sys.byteorder == 'little':
+        return memoryview(b).cast('H')
+    a = array.array('H', bytes(b))
+    a.byteswap()
+    return a
 
+# The usage and labels tables are sparse, keyed by word address and by
+# byte address respectively.  Only the range of words that has been loaded
+# is tracked, so that reset() costs time proportional to the size of the
+# last image rather than to the 64K word address space.
+class Memory:
+    def __init__(self, size = 65536):
+        self.size = size
+        self.bytes = bytearray(size * 2)
+        self.words = word_view(self.bytes)
+        self.usage = {}
+        self.labels = {}
+        self.touched_lo = size
+        self.touched_hi = 0
+
+    def reset(self):
+        if self.touched_lo < self.touched_hi:
+            lo = self.touched_lo * 2
+            hi = self.touched_hi * 2
+            self.bytes[lo:hi] = bytes(hi - lo)
+            if sys.byteorder != 'little':
+                self.words = word_view(self.bytes)
+        self.usage.clear()
+        self.labels.clear()
+        self.touched_lo = self.size
+        self.touched_hi = 0
+
+    # Read up to count words from f, in one call, into memory starting at
+    # word address base.  Returns the number of words read.
+    def load(self, f, base, count):
+        count = min(count, self.size - base)
+        buf = memoryview(self.bytes)[base * 2 : (base + count) * 2]
+        if hasattr(f, 'readinto'):
+            n = f.readinto(buf)
+        else:
+            data = f.read(len(buf))
+            n = len(data)
+            buf[:n] = data
+        buf.release()
+        self.touched_lo = min(self.touched_lo, base)
+        self.touched_hi = max(self.touched_hi, base + (n + 1) // 2)
+        if sys.byteorder != 'little':
+            self.words = word_view(self.bytes)
+        return n // 2
+
+    # Copy the bytes of data into memory starting at word address base.
+    def store(self, base, data):
+        n = min(len(data), (self.size - base) * 2)
+        self.bytes[base * 2 : base * 2 + n] = data[:n]
+        self.touched_lo = min(self.touched_lo, base)
+        self.touched_hi = max(self.touched_hi, base + (n + 1) // 2)
+        if sys.byteorder != 'little':
+            self.words = word_view(self.bytes)
+        return n // 2
 
 optab     = { 0x00: ('sldc', 'literal', 0x00),
               0x01: ('sldc', 'literal', 0x01),
@@ -221,88 +284,184 @@ optab     = { 0x00: ('sldc', 'literal', 0x00),
               0xe6: ('ind', 'literal', 'b'),
               0xe7: ('inc', 'literal', 'b')
               }
-    
-def read_words(f, count):
-    global image_base, image_len, mem
-    image_base = 0
-    image_len = 0
-    while count:
-        bytes = f.read(2)
-        mem[image_base + image_len] = (bytes[1] << 8) + bytes[0]
-        image_len += 1
-        count -= 1
-    
-def read_image(f, base):
-    global image_base, image_len, mem
-    image_base = base
-    image_len = 0
-    bytes = f.read(2)
-    while bytes:
-        mem[image_base + image_len] = (bytes[1] << 8) + bytes[0]
-        image_len += 1
-        bytes = f.read(2)
-
-def get_word(addr, name, file = None):
-    w = mem[addr]
-    if file is not None:
-        print("%04x:  %04x  %s" % (addr, w, name), file = file)
-    return w
-
-def get_byte(addr, name, high, file = None):
-    w = mem[addr]
-    if high:
-        b = w >> 8
-    else:
-        b = w & 0xff
-    if file is not None:
-        print("%04x%s: %02x    %s" % (addr, "LH"[int(high)], b, name), file = file)
-    return b
 
-def get_byte_offset_addr_str(seg_base, seg_name, byte_offset, proc_name):
-    addr = seg_base + (byte_offset >> 1)
-    high = (byte_offset & 1) != 0
-    return "%04x%s %s+%04x %s" % (addr, "LH"[int(high)],
-                                   seg_name, byte_offset,
-                                   proc_name)
 
-def get_byte_offset(seg_base, seg_name, byte_offset, proc_name, file = None):
-    addr = seg_base + (byte_offset >> 1)
-    high = (byte_offset & 1) != 0
-    w = mem[addr]
-    if high:
-        b = w >> 8
-    else:
-        b = w & 0xff
-    if file is not None:
-        print("%s: %02x" % (get_byte_offset_addr_str(seg_base, seg_name,
-                                                     byte_offset, proc_name),
-                            b),
-              file = file)
-    return b
+# optab is compiled once, at import time, into decode_table, a list indexed
+# by opcode byte.  Each entry gives the operand layout of the opcode, its
+# length if that doesn't depend on the operand values, and a format string
+# that renders the mnemonic and all of its operands in one operation.
 
+# operand fetch kinds
+IMM  = 0  # value comes from the opcode table, no bytes fetched
+BIG  = 1  # 'b':  one byte, or two if the first has its high bit set
+WORD = 2  # 'w':  signed 16-bit little-endian word
+UB   = 3  # 'ub', 'db': unsigned byte
+SB   = 4  # 'sb': signed byte
 
+operand_fetch = { 'b': BIG, 'w': WORD, 'ub': UB, 'db': UB, 'sb': SB }
 
-def dis_boot_param_pointer(addr, name, file = None):
-    if memusage[addr] is None:
-        memusage[addr] = ['boot_param_pointer', 1]
-    else:
-        assert memusage[addr][0] == 'boot_param_pointer'
+Operand = collections.namedtuple('Operand', ['fetch', 'render', 'value'])
 
-    return get_word(addr, name, file)
+DecodeEntry = collections.namedtuple('DecodeEntry', ['opcode',
+                                                     'mnem',
+                                                     'operands',
+                                                     'length',
+                                                     'fmt',
+                                                     'imm_operands',
+                                                     'imm_renders'])
+
+def compile_opcode(opcode, inst):
+    mnem = inst[0]
+    fmt = ('%-8s' % mnem).replace('%', '%%')
+    operands = []
+    length = 1
+    flags = set()
+    for item in inst[1:]:
+        if type(item) == int:
+            fetch = IMM
+        elif item in operand_fetch:
+            fetch = operand_fetch[item]
+        else:
+            flags.add(item)
+            continue
+        if fetch == BIG:
+            length = None
+        elif length is not None:
+            length += [0, 0, 2, 1, 1][fetch]
+        if 'case' in flags:
+            render = 'case'
+        elif 'segment' in flags:
+            render = 'segment'
+            fmt += ' seg%d'
+        elif 'code' in flags:
+            render = 'code'
+            fmt += ' %s\t; %s+%04x'
+        elif 'intermediate' in flags:
+            render = 'intermediate'
+            fmt += ' intermediate %d'
+        elif 'proc' in flags:
+            render = 'proc'
+            if 'global' in flags:
+                fmt += ' global proc%d'
+            elif 'local' in flags:
+                fmt += ' local proc%d'
+            else:
+                fmt += ' proc%d'
+        elif 'global' in flags:
+            render = 'global'
+            fmt += ' global_%d'
+        elif 'local' in flags:
+            render = 'local'
+            fmt += ' local_%d'
+        else:
+            render = 'literal'
+            fmt += ' %d'
+        operands.append(Operand(fetch = fetch,
+                                render = render,
+                                value = item if fetch == IMM else None))
+        flags = set()
+    imm_operands = ()
+    imm_renders = ()
+    if all(opnd.fetch == IMM for opnd in operands):
+        # nothing to fetch, so the text is fixed
+        imm_operands = tuple(opnd.value for opnd in operands)
+        imm_renders = tuple(opnd.render for opnd in operands)
+        fmt = fmt % imm_operands
+        operands = []
+    return DecodeEntry(opcode = opcode,
+                       mnem = mnem,
+                       operands = tuple(operands),
+                       length = length,
+                       fmt = fmt,
+                       imm_operands = imm_operands,
+                       imm_renders = imm_renders)
+
+def compile_optab(optab):
+    return [compile_opcode(opcode, optab.get(opcode, ('undefined',)))
+            for opcode in range(256)]
+
+decode_table = compile_optab(optab)
+
+# Decode the instruction at index pos of the byte buffer code.  Returns
+# the decode table entry, the instruction length in bytes, and a list of
+# operand values, one per entry in the operands of the decode table entry.
+def decode_inst(code, pos):
+    entry = decode_table[code[pos]]
+    if not entry.operands:
+        return entry, 1, ()
+    p = pos + 1
+    parms = []
+    for opnd in entry.operands:
+        fetch = opnd.fetch
+        if fetch == IMM:
+            parm = opnd.value
+        elif fetch == UB:
+            parm = code[p]
+            p += 1
+        elif fetch == SB:
+            parm = code[p]
+            if parm >= 128:
+                parm -= 256
+            p += 1
+        elif fetch == BIG:
+            parm = code[p]
+            p += 1
+            if parm >= 128:
+                parm = ((parm - 128) << 8) + code[p]
+                p += 1
+        else:
+            parm = code[p] + (code[p + 1] << 8)
+            if parm >= 32768:
+                parm -= 65536
+            p += 2
+        parms.append(parm)
+    return entry, p - pos, parms
+
+
+DecodedInst = collections.namedtuple('DecodedInst', ['byte_offset',
+                                                     'length',
+                                                     'entry',    # decode_table entry
+                                                     'operands', # operand values
+                                                     'text',     # mnemonic and operands
+                                                     'labels'])  # (byte offset, label) pairs added
+
+# Instructions that end a basic block, by the kind of control transfer.
+# Conditional jumps and xjp fall through when not taken; xjp jumps
+# through a case table, and falls through when the index is out of range.
+unconditional_jumps = frozenset(['ujp', 'ujpl'])
+conditional_jumps   = frozenset(['fjp', 'fjpl', 'efj', 'nfj'])
+case_jumps          = frozenset(['xjp'])
+returns             = frozenset(['rpu'])
+
+# Procedure calls, within the segment and to other segments
+call_insts = frozenset(['cpl', 'cpg', 'cpi', 'cxl', 'cxg', 'cxi'])
+
+# A call from procedure proc (a name such as 'proc3') at byte_offset, to
+# procedure number target_proc of segment number seg_num, or of the same
+# segment if seg_num is None.
+CallSite = collections.namedtuple('CallSite', ['proc', 'byte_offset', 'mnem', 'seg_num', 'target_proc'])
+
+# A reference to a label or variable by the instruction at byte_offset of
+# procedure proc.
+XrefSite = collections.namedtuple('XrefSite', ['proc', 'byte_offset', 'mnem'])
+
+# A basic block of a procedure, from byte offset start up to end, with
+# last the byte offset of its last instruction, and succs a tuple of
+# (target byte offset, kind) where kind is 'fall', 'jump', 'branch' or
+# 'case', or 'exit' for a target outside the procedure's code, which
+# has no block.
+BasicBlock = collections.namedtuple('BasicBlock', ['start', 'end', 'last', 'succs'])
+
+# The control flow graph of a procedure, found by recursive descent from
+# its entry point.  blocks is a dict of BasicBlock by start offset, in
+# address order, inst_offsets is a sorted list of the byte offsets of the
+# reachable instructions, and unreachable is a list of (start, end) byte
+# ranges of the procedure that no reachable instruction covers.
+ProcCFG = collections.namedtuple('ProcCFG', ['entry', 'end_offset', 'blocks', 'inst_offsets',
+                                             'unreachable'])
 
 BootParams = collections.namedtuple('BootParams', ['ctp', 'sdp', 'rqp'])
 
-def dis_boot_params(addr, name, file = None):
-    if memusage[addr] is None:
-        memusage[addr] = ['boot_params', 3]
-    else:
-        assert memusage[addr][0] == 'boot_params'
-    
-    ctp = get_word(addr + 0, name + '.ctp', file)
-    sdp = get_word(addr + 1, name + '.sdp', file)
-    rqp = get_word(addr + 2, name + '.rqp', file)
-    return BootParams(ctp = ctp, sdp = sdp, rqp = rqp)
-    
 TIB = collections.namedtuple('TIB', ['waitq',
                                      'prior',
                                      'flags',
@@ -317,51 +476,6 @@ TIB = collections.namedtuple('TIB', ['waitq',
                                      'iorslt',
                                      'sibsvec'])
 
-def dis_tib(addr, name, file = None):
-    if memusage[addr] is None:
-        memusage[addr] = ['tib', 12]
-    else:
-        assert memusage[addr][0] == 'tib'
-    
-    waitq   = get_word(addr +  0, name + '.waitq',        file)
-    prior   = get_byte(addr +  1, name + '.prior', False, file)
-    flags   = get_byte(addr +  1, name + '.flags', False, file)
-    splow   = get_word(addr +  2, name + '.splow',        file)
-    spupr   = get_word(addr +  3, name + '.spupr',        file)
-    sp      = get_word(addr +  4, name + '.sp',           file)
-    mp      = get_word(addr +  5, name + '.mp',           file)
-    bp      = get_word(addr +  6, name + '.bp',           file)
-    ipc     = get_word(addr +  7, name + '.ipc',          file)
-    segb    = get_word(addr +  8, name + '.segb',         file)
-    hangp   = get_word(addr +  9, name + '.hangp',        file)
-    iorslt  = get_word(addr + 10, name + '.iorslt',       file)
-    sibsvec = get_word(addr + 11, name + '.sibsvec',      file)
-    return TIB(waitq   = waitq,
-               prior   = prior,
-               flags   = flags,
-               splow   = splow,
-               spupr   = spupr,
-               sp      = sp,
-               mp      = mp,
-               bp      = bp,
-               ipc     = ipc,
-               segb    = segb,
-               hangp   = hangp,
-               iorslt  = iorslt,
-               sibsvec = sibsvec)
-
-def dis_sibsvec(addr, count, name, file = None):
-    if memusage[addr] is None:
-        memusage[addr] = ['sibsvec', count]
-    else:
-        assert memusage[addr][0] == 'sibsvec'
-        count = memusage[addr][1]
-    
-    sibsvec = [0] * count
-    for i in range(count):
-        sibsvec[i] = get_word(addr + i, name + '[%d]' % i, file)
-    return sibsvec
-
 SIB = collections.namedtuple('SIB', ['segbase',
                                      'segleng',
                                      'segrefs',
@@ -369,305 +483,1041 @@ SIB = collections.namedtuple('SIB', ['segbase',
                                      'segunit',
                                      'prevsp'])
 
-# AOS track 0 bootstrap seems to only use a three-word SIB entry
-def dis_sib(addr, name, short = False, file = None):
-    if memusage[addr] is None:
-        memusage[addr] = ['sib', 3 if short else 6]
-    else:
-        assert memusage[addr][0] == 'sib'
-        short = memusage[addr][1] == 3
-    
-    segbase = get_word(addr + 0, name + '.segbase', file)
-    segleng = get_word(addr + 1, name + '.segleng', file)
-    if not short:
-        segrefs = get_word(addr + 2, name + '.segrefs', file)
-        segaddr = get_word(addr + 3, name + '.segaddr', file)
-        segunit = get_word(addr + 4, name + '.segunit', file)
-        prevsp  = get_word(addr + 5, name + '.prevsp',  file)
-    else:
-        unknown = get_word(addr + 2, name + '.segunk', file)
-        segrefs = None
-        segaddr = None
-        segunit = None
-        prevsp  = None
-    return SIB(segbase = segbase,
-               segleng = segleng,
-               segrefs = segrefs,
-               segaddr = segaddr,
-               segunit = segunit,
-               prevsp  = prevsp)
-
-def dis_case(seg_base, seg_name, proc_name, table_offset, jump_offset, name, file = None):
-    global next_label_num
-
-    if memusage[seg_base + table_offset] is None:
-        first = get_word(seg_base + table_offset + 0, name + '.min', file)
-        last  = get_word(seg_base + table_offset + 1, name + '.max', file)
-        count = last + 1 - first
-        memusage[seg_base + table_offset] = ['case', count + 2, proc_name, jump_offset, name]
-        print('%04x' % (seg_base + table_offset), memusage[seg_base + table_offset])
-    else:
-        assert memusage[seg_base + table_offset][0] == 'case'
-        if proc_name is None:
-            proc_name = memusage[seg_base + table_offset][2]
-        if jump_offset is None:
-            jump_offset = memusage[seg_base + table_offset][3]
-        if name is None:
-            name = memusage[seg_base + table_offset][4]
-        first = get_word(seg_base + table_offset + 0, name + '.min', file)
-        last  = get_word(seg_base + table_offset + 1, name + '.max', file)
-        count = last + 1 - first
-
-    offsets = [None] * count
-    for i in range(count):
-        t = get_word(seg_base + table_offset + 2 + i, name+'.idx%04x' % (first + i), file) + jump_offset
-        offsets[i] = t
-        if proc_name is not None:
-            add_label(seg_base, t, '%s.%s.%02x' % (seg_name, proc_name, next_label_num))
-            next_label_num += 1
-
-def dis_inst(seg_num, seg_base, seg_name, proc_name, byte_offset, file = None):
-    global next_label_num
-    ibytes = [get_byte_offset(seg_base, seg_name, byte_offset, proc_name, None)]
-
-    inst = list(optab.get(ibytes[0], ('undefined',)))
-    mnem = inst[0]
-    s = "%-8s" % mnem
-    flags = { 'literal':      False,
-              'local':        False,
-              'global':       False,
-              'intermediate': False,
-              'const':        False,
-              'relative':     False,
-              'proc':         False,
-              'segment':      False,
-              'code':         False,
-              'case':         False, }
-    have_parm = False
-    for i in range(1, len(inst)):
-        if inst[i] in flags:
-            flags[inst[i]] = True
-        elif inst[i] == 'b':
-            ibytes.append(get_byte_offset(seg_base, seg_name, byte_offset + len(ibytes), proc_name, file = None))
-            parm = ibytes[len(ibytes)-1]
-            parm_size = 8
-            if (parm >= 128):
-                ibytes.append(get_byte_offset(seg_base, seg_name, byte_offset + len(ibytes), proc_name, file = None))
-                parm = ((parm - 128) << 8) + ibytes[len(ibytes)-1]
-                parm_size = 16
-            have_parm = True
-        elif inst[i] == 'w':
-            ibytes.append(get_byte_offset(seg_base, seg_name, byte_offset + len(ibytes), proc_name, file = None))
-            ibytes.append(get_byte_offset(seg_base, seg_name, byte_offset + len(ibytes), proc_name, file = None))
-            parm = (ibytes[len(ibytes)-1] << 8) + ibytes[len(ibytes)-2]
-            if (parm >= 32768):
-                parm -= 65536
-            parm_size = 16
-            have_parm = True
-        elif inst[i] == 'ub' or inst[i] == 'db':
-            ibytes.append(get_byte_offset(seg_base, seg_name, byte_offset + len(ibytes), proc_name, file = None))
-            parm = ibytes[len(ibytes)-1]
-            parm_size = 8
-            have_parm = True
-        elif inst[i] == 'sb':
-            ibytes.append(get_byte_offset(seg_base, seg_name, byte_offset + len(ibytes), proc_name, file = None))
-            parm = ibytes[len(ibytes)-1]
-            if parm >= 128:
-                parm -= 256
-            parm_size = 8
-            have_parm = True
-        elif type(inst[i]) == int:
-            parm = inst[i]
-            parm_size = 8
-            have_parm = True
+def get_byte_offset_addr_str(seg_base, seg_name, byte_offset, proc_name):
+    addr = seg_base + (byte_offset >> 1)
+    high = (byte_offset & 1) != 0
+    return "%04x%s %s+%04x %s" % (addr, "LH"[int(high)],
+                                   seg_name, byte_offset,
+                                   proc_name)
+
+
+# The disassembly is produced as a stream of records, which a renderer
+# turns into output.  The text renderer produces the traditional listing;
+# the others produce one record per line for use by other tools.
+
+class Record:
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def as_dict(self):
+        d = { 'type': self.type }
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, bytes):
+                value = value.hex()
+            d[name] = value
+        return d
+
+class SegmentEntry(Record):
+    type = 'segment_entry'
+    __slots__ = ('seg_num', 'block', 'length', 'name', 'kind', 'addr', 'codeversion')
+
+class SegmentHeader(Record):
+    type = 'segment'
+    __slots__ = ('seg_num', 'seg_base', 'seg_length', 'seg_name', 'proc_dir_offset')
+
+class Procedure(Record):
+    type = 'procedure'
+    __slots__ = ('seg_base', 'seg_name', 'proc_name', 'proc_offset', 'end_offset', 'local_size')
+
+class Instruction(Record):
+    type = 'instruction'
+    __slots__ = ('seg_base', 'seg_name', 'proc_name', 'byte_offset', 'code',
+                 'label', 'mnem', 'operands', 'targets', 'text')
+
+    # spelled out, since this is by far the most common record
+    def __init__(self, seg_base, seg_name, proc_name, byte_offset, code,
+                 label, mnem, operands, targets, text):
+        self.seg_base = seg_base
+        self.seg_name = seg_name
+        self.proc_name = proc_name
+        self.byte_offset = byte_offset
+        self.code = code
+        self.label = label
+        self.mnem = mnem
+        self.operands = operands
+        self.targets = targets
+        self.text = text
+
+    def as_dict(self):
+        d = Record.as_dict(self)
+        d['addr'] = self.seg_base + (self.byte_offset >> 1)
+        return d
+
+class CodeByte(Record):
+    type = 'code_byte'
+    __slots__ = ('seg_base', 'seg_name', 'byte_offset', 'proc_name', 'value')
+
+class DataWord(Record):
+    type = 'word'
+    __slots__ = ('addr', 'value', 'name')
+
+    def __init__(self, addr, value, name):
+        self.addr = addr
+        self.value = value
+        self.name = name
+
+# a run of count identical words, starting at addr
+class DataFill(Record):
+    type = 'fill'
+    __slots__ = ('addr', 'count', 'value')
+
+class DataByte(Record):
+    type = 'byte'
+    __slots__ = ('addr', 'high', 'value', 'name')
+
+class CaseTable(Record):
+    type = 'case_table'
+    __slots__ = ('addr', 'name', 'first', 'last', 'entries', 'targets')
+
+class Message(Record):
+    type = 'message'
+    __slots__ = ('text',)
+
+# a procedure recognized from a signature database as name; if skipped,
+# its instructions aren't listed
+class KnownProc(Record):
+    type = 'known_proc'
+    __slots__ = ('seg_base', 'seg_name', 'proc_name', 'name', 'skipped')
+
+# the sites referring to a label or variable; proc_name is None for
+# global variables
+class Xref(Record):
+    type = 'xref'
+    __slots__ = ('seg_base', 'seg_name', 'proc_name', 'name', 'sites')
+
+    def as_dict(self):
+        return { 'type':      self.type,
+                 'seg_name':  self.seg_name,
+                 'proc_name': self.proc_name,
+                 'name':      self.name,
+                 'sites':     [site._asdict() for site in self.sites] }
+
+class ControlFlow(Record):
+    type = 'cfg'
+    __slots__ = ('seg_base', 'seg_name', 'proc_name', 'entry', 'blocks', 'unreachable')
+
+    def as_dict(self):
+        return { 'type':        self.type,
+                 'seg_name':    self.seg_name,
+                 'proc_name':   self.proc_name,
+                 'entry':       self.entry,
+                 'blocks':      [{ 'start': b.start,
+                                   'end':   b.end,
+                                   'succs': [list(s) for s in b.succs] }
+                                 for b in self.blocks],
+                 'unreachable': [list(r) for r in self.unreachable] }
+
+
+class Renderer:
+    def __init__(self, file, header = True):
+        self.file = file
+
+    def record(self, rec):
+        raise NotImplementedError
+
+    # a blank line, which only matters to the text listing
+    def blank(self):
+        pass
+
+    # write out anything buffered
+    def flush(self):
+        pass
+
+# The text renderer formats each line with a single format operation and
+# collects the lines, writing them to the file in large batches rather
+# than with a write per field.  flush() must be called when the output is
+# complete, or before anything else is written to the same file.
+class TextRenderer(Renderer):
+    batch_lines = 8192
+
+    def __init__(self, file, header = True):
+        Renderer.__init__(self, file, header)
+        self.lines = []
+        self.formatters = { 'segment_entry': self.text_segment_entry,
+                            'segment':       self.text_segment,
+                            'procedure':     self.text_procedure,
+                            'instruction':   self.text_instruction,
+                            'code_byte':     self.text_code_byte,
+                            'word':          self.text_word,
+                            'fill':          self.text_fill,
+                            'byte':          self.text_byte,
+                            'case_table':    self.text_case_table,
+                            'message':       self.text_message,
+                            'known_proc':    self.text_known_proc,
+                            'cfg':           self.text_cfg,
+                            'xref':          self.text_xref }
+
+    def record(self, rec):
+        self.formatters[rec.type](rec)
+        if len(self.lines) >= self.batch_lines:
+            self.flush()
+
+    def blank(self):
+        self.lines.append('\n')
+
+    def flush(self):
+        if self.lines:
+            self.file.write(''.join(self.lines))
+            self.lines.clear()
+
+    def text_segment_entry(self, rec):
+        self.lines.append('seg%02d: %04x %04x %s %-8s %04x %04x\n' % (rec.seg_num,
+                                                                      rec.block,
+                                                                      rec.length,
+                                                                      rec.name,
+                                                                      rec.kind,
+                                                                      rec.addr,
+                                                                      rec.codeversion))
+
+    def text_segment(self, rec):
+        self.lines.append("%04x:  %04x  %s.procdir\n\n" % (rec.seg_base, rec.proc_dir_offset, rec.seg_name))
+
+    def text_procedure(self, rec):
+        addr = rec.seg_base + rec.proc_offset
+        self.lines.append("%04x:  %04x  %s.endoffset\n%04x:  %04x  %s.localsize\n" %
+                          (addr - 1, rec.end_offset, rec.proc_name,
+                           addr, rec.local_size, rec.proc_name))
+
+    def text_instruction(self, rec):
+        byte_offset = rec.byte_offset
+        label = rec.label
+        self.lines.append("%04x%s %s+%04x %s: %-11s%-19s %s\n" %
+                          (rec.seg_base + (byte_offset >> 1),
+                           "LH"[byte_offset & 1],
+                           rec.seg_name,
+                           byte_offset,
+                           rec.proc_name,
+                           rec.code[:4].hex(' '),
+                           '' if label is None else label + ':',
+                           rec.text))
+
+    def text_code_byte(self, rec):
+        self.lines.append("%s: %02x\n" % (get_byte_offset_addr_str(rec.seg_base, rec.seg_name,
+                                                                   rec.byte_offset, rec.proc_name),
+                                          rec.value))
+
+    def text_word(self, rec):
+        self.lines.append("%04x:  %04x  %s\n" % (rec.addr, rec.value, rec.name))
+
+    def text_fill(self, rec):
+        self.lines.append("%04x-%04x:  %04x  fill %d\n" % (rec.addr, rec.addr + rec.count - 1, rec.value, rec.count))
+
+    def text_byte(self, rec):
+        self.lines.append("%04x%s: %02x    %s\n" % (rec.addr, "LH"[int(rec.high)], rec.value, rec.name))
+
+    def text_case_table(self, rec):
+        self.lines.append("%04x:  %04x  %s.min\n" % (rec.addr + 0, rec.first, rec.name))
+        self.lines.append("%04x:  %04x  %s.max\n" % (rec.addr + 1, rec.last, rec.name))
+        for i in range(len(rec.entries)):
+            self.lines.append("%04x:  %04x  %s.idx%04x\n" % (rec.addr + 2 + i, rec.entries[i], rec.name, rec.first + i))
+
+    def text_message(self, rec):
+        self.lines.append(rec.text + '\n')
+
+    def text_known_proc(self, rec):
+        self.lines.append('; %s is %s%s\n' % (rec.proc_name, rec.name, ', not listed' if rec.skipped else ''))
+
+    def text_xref(self, rec):
+        self.lines.append('; %-19s %s\n' % (rec.name, ', '.join('%04x %s' % (site.byte_offset, site.mnem)
+                                                              if site.proc == rec.proc_name else
+                                                              '%s+%04x %s' % (site.proc, site.byte_offset, site.mnem)
+                                                              for site in rec.sites)))
+
+    def text_cfg(self, rec):
+        self.lines.append('%s.%s: %d basic blocks\n' % (rec.seg_name, rec.proc_name, len(rec.blocks)))
+        for b in rec.blocks:
+            self.lines.append('  %04x-%04x -> %s\n' % (b.start, b.end - 1,
+                                                       ' '.join('%04x %s' % s for s in b.succs)))
+        for start, end in rec.unreachable:
+            self.lines.append('  %04x-%04x unreachable\n' % (start, end - 1))
+
+class JsonLinesRenderer(Renderer):
+    def record(self, rec):
+        self.file.write(json.dumps(rec.as_dict()) + '\n')
+
+class CsvRenderer(Renderer):
+    columns = ['type', 'addr', 'seg_name', 'proc_name', 'byte_offset', 'code',
+               'label', 'mnem', 'operands', 'targets', 'value', 'name', 'text', 'count']
+
+    def __init__(self, file, header = True):
+        Renderer.__init__(self, file, header)
+        self.writer = csv.writer(file, lineterminator = '\n')
+        if header:
+            self.writer.writerow(self.columns)
+
+    def record(self, rec):
+        # control flow graphs don't fit in a table
+        if rec.type == 'cfg':
+            return
+        d = rec.as_dict()
+        row = []
+        for column in self.columns:
+            value = d.get(column)
+            if value is None:
+                value = ''
+            elif isinstance(value, list) or isinstance(value, tuple):
+                value = ' '.join(str(v) for v in value)
+            row.append(value)
+        self.writer.writerow(row)
+
+# The DOT renderer writes only the control flow graphs, one digraph per
+# procedure, each node a basic block labelled with its byte range, and
+# each target outside the procedure a plain node labelled with its offset.
+class DotRenderer(Renderer):
+    def record(self, rec):
+        if rec.type != 'cfg':
+            return
+        lines = ['digraph "%s.%s" {\n' % (rec.seg_name, rec.proc_name),
+                 '  node [shape=box, fontname="monospace"];\n']
+        for b in rec.blocks:
+            lines.append('  b%04x [label="%04x-%04x"%s];\n' % (b.start, b.start, b.end - 1,
+                                                              ', peripheries=2' if b.start == rec.entry else ''))
+        exits = sorted(set(target for b in rec.blocks for target, kind in b.succs if kind == 'exit'))
+        for target in exits:
+            lines.append('  x%04x [label="%04x", shape=plaintext];\n' % (target, target))
+        for b in rec.blocks:
+            for target, kind in b.succs:
+                lines.append('  b%04x -> %s%04x [label="%s"];\n' % (b.start, 'x' if kind == 'exit' else 'b', target, kind))
+        lines.append('}\n')
+        self.file.write(''.join(lines))
+
+renderers = { 'text':  TextRenderer,
+              'jsonl': JsonLinesRenderer,
+              'csv':   CsvRenderer,
+              'dot':   DotRenderer }
+
+
+# A Disassembler owns a memory image and the tables built while
+# disassembling it, so several instances can be used independently,
+# including concurrently from different threads.  Diagnostic messages
+# go to log, or to standard output if log is None.  If fill is not None,
+# runs of at least fill identical data words are listed as a single line.
+# If descent is true, procedures are decoded by recursive descent from
+# their entry points, and bytes that aren't reachable are listed as data.
+# If cfg is true, each procedure's control flow graph is output after it,
+# and if xref is true, so are its cross references, with those of the
+# global variables after each segment.
+class Disassembler:
+    def __init__(self, memory = None, log = None, fill = None, descent = False, cfg = False, xref = False,
+                 signatures = None, skip_known = False, stats = None):
+        self.memory = memory if memory is not None else Memory()
+        self.log = log
+        self.fill = fill
+        self.descent = descent
+        self.cfg = cfg
+        self.xref = xref
+        self.signatures = signatures
+        self.skip_known = skip_known
+        self.procs = None
+        self.stats = stats
+        if stats is not None:
+            self.instrument(stats)
+        self.mem_init()
+
+    # Time the phases of disassembly, by replacing the methods that make
+    # them up with timed versions.
+    def instrument(self, stats):
+        for name, phase in [('read_words',     'load'),
+                            ('load_words',     'load'),
+                            ('load_procs',     'load'),
+                            ('read_image',     'load'),
+                            ('decode_proc',    'decode'),
+                            ('proc_cfg',       'cfg'),
+                            ('dis_case',       'case_tables'),
+                            ('pass_1_rom',     'pass_1'),
+                            ('pass_1_wdboot',  'pass_1'),
+                            ('pass_1_acdboot', 'pass_1'),
+                            ('pass_2',         'pass_2')]:
+            setattr(self, name, stats.timed(phase, getattr(self, name)))
+
+    def phase(self, name):
+        return stats_phase(self.stats, name)
+
+    def mem_init(self):
+        self.image_base = 0
+        self.image_len = 0
+        self.memory.reset()
+        self.mem = self.memory.words
+        self.mem_bytes = self.memory.bytes
+        self.memusage = self.memory.usage
+        self.labels = self.memory.labels
+        self.decoded_procs = {}
+        self.cfgs = {}
+        self.calls = []
+        self.label_refs = {}   # byte address -> [XrefSite, ...]
+        self.var_refs = {}     # (seg_base, proc name or None) -> { variable: [XrefSite, ...] }
+        self.known_procs = {}  # (seg_base, proc_offset, end_offset) -> name from signatures
+
+    def add_label(self, seg_base, byte_offset, label):
+        self.labels[seg_base * 2 + byte_offset] = label
+
+    def read_words(self, f, count):
+        self.image_base = 0
+        self.image_len = self.memory.load(f, self.image_base, count)
+        self.mem = self.memory.words
+
+    def load_words(self, data, base = 0):
+        self.image_base = base
+        self.image_len = self.memory.store(base, data)
+        self.mem = self.memory.words
+
+    # Load only word 0, the procedure dictionary, and the procedures whose
+    # numbers are in procs from data, a segment of seg_length words.
+    # Each procedure is taken to extend up to the next one in memory, or
+    # to the procedure dictionary.  Returns the procedure numbers that
+    # exist in the segment.
+    def load_procs(self, data, seg_length, procs):
+        data = memoryview(data)[:seg_length * 2]
+        seg_length = len(data) // 2
+        self.image_base = 0
+        self.image_len = seg_length
+        self.memory.store(0, data[0:2])
+        self.mem = self.memory.words
+        proc_dir_offset = self.mem[0]
+        if proc_dir_offset >= seg_length:
+            return []
+        self.memory.store(proc_dir_offset, data[proc_dir_offset * 2 : proc_dir_offset * 2 + 2])
+        num_proc = self.mem[proc_dir_offset] >> 8
+        self.memory.store(proc_dir_offset - num_proc,
+                          data[(proc_dir_offset - num_proc) * 2 : proc_dir_offset * 2])
+        self.mem = self.memory.words
+        starts = sorted(self.mem[proc_dir_offset - i] for i in range(1, num_proc + 1))
+        found = []
+        for i in sorted(set(procs)):
+            if not 1 <= i <= num_proc:
+                continue
+            po = self.mem[proc_dir_offset - i]
+            if not 1 <= po < proc_dir_offset:
+                continue
+            end = min([s for s in starts if s > po] + [proc_dir_offset - num_proc])
+            self.memory.store(po - 1, data[(po - 1) * 2 : end * 2])
+            found.append(i)
+        data.release()
+        self.mem = self.memory.words
+        return found
+
+    def read_image(self, f, base):
+        self.image_base = base
+        self.image_len = self.memory.load(f, self.image_base, 65536 - self.image_base)
+        self.mem = self.memory.words
+
+    def get_word(self, addr, name, out = None):
+        w = self.mem[addr]
+        if out is not None:
+            out.record(DataWord(addr, w, name))
+        return w
+
+    def get_byte(self, addr, name, high, out = None):
+        b = self.mem_bytes[addr * 2 + int(high)]
+        if out is not None:
+            out.record(DataByte(addr, high, b, name))
+        return b
+
+    def get_byte_offset(self, seg_base, seg_name, byte_offset, proc_name, out = None):
+        b = self.mem_bytes[seg_base * 2 + byte_offset]
+        if out is not None:
+            out.record(CodeByte(seg_base, seg_name, byte_offset, proc_name, b))
+        return b
+
+    def dis_boot_param_pointer(self, addr, name, out = None):
+        if self.memusage.get(addr) is None:
+            self.memusage[addr] = ['boot_param_pointer', 1]
         else:
-            raise Exception("invalid entry in opcode table: " + str(inst[i]))
-        if have_parm:
-            # XXX here is where we should handle flags
-            if flags['case']:
-                dis_case(seg_base, seg_name, proc_name, parm, byte_offset + len(ibytes), proc_name + '.case_%04x' % byte_offset, file = None)
-            elif flags['segment']:
-                s = s + ' seg%d' % parm
-            elif flags['code']:
-                t = byte_offset + len(ibytes) + parm
-                label = '%s.%s.%02x' % (seg_name, proc_name, next_label_num)
-                s = s + ' %s\t; %s+%04x' % (label, seg_name, t)
-                add_label(seg_base, t, label)
-                next_label_num += 1
-            elif flags['intermediate']:
-                s = s + ' intermediate %d' % parm
-            elif flags['proc']:
-                if flags['global']:
-                    s = s + ' global proc%d' % parm
-                elif flags['local']:
-                    s = s + ' local proc%d' % parm
-                else:
-                    s = s + ' proc%d' % parm
-            elif flags['global']:
-                s = s + ' global_%d' % parm
-            elif flags['local']:
-                s = s + ' local_%d' % parm
+            assert self.memusage[addr][0] == 'boot_param_pointer'
+
+        return self.get_word(addr, name, out)
+
+    def dis_boot_params(self, addr, name, out = None):
+        if self.memusage.get(addr) is None:
+            self.memusage[addr] = ['boot_params', 3]
+        else:
+            assert self.memusage[addr][0] == 'boot_params'
+
+        ctp = self.get_word(addr + 0, name + '.ctp', out)
+        sdp = self.get_word(addr + 1, name + '.sdp', out)
+        rqp = self.get_word(addr + 2, name + '.rqp', out)
+        return BootParams(ctp = ctp, sdp = sdp, rqp = rqp)
+
+
+    def dis_tib(self, addr, name, out = None):
+        if self.memusage.get(addr) is None:
+            self.memusage[addr] = ['tib', 12]
+        else:
+            assert self.memusage[addr][0] == 'tib'
+
+        waitq   = self.get_word(addr +  0, name + '.waitq',        out)
+        prior   = self.get_byte(addr +  1, name + '.prior', False, out)
+        flags   = self.get_byte(addr +  1, name + '.flags', False, out)
+        splow   = self.get_word(addr +  2, name + '.splow',        out)
+        spupr   = self.get_word(addr +  3, name + '.spupr',        out)
+        sp      = self.get_word(addr +  4, name + '.sp',           out)
+        mp      = self.get_word(addr +  5, name + '.mp',           out)
+        bp      = self.get_word(addr +  6, name + '.bp',           out)
+        ipc     = self.get_word(addr +  7, name + '.ipc',          out)
+        segb    = self.get_word(addr +  8, name + '.segb',         out)
+        hangp   = self.get_word(addr +  9, name + '.hangp',        out)
+        iorslt  = self.get_word(addr + 10, name + '.iorslt',       out)
+        sibsvec = self.get_word(addr + 11, name + '.sibsvec',      out)
+        return TIB(waitq   = waitq,
+                   prior   = prior,
+                   flags   = flags,
+                   splow   = splow,
+                   spupr   = spupr,
+                   sp      = sp,
+                   mp      = mp,
+                   bp      = bp,
+                   ipc     = ipc,
+                   segb    = segb,
+                   hangp   = hangp,
+                   iorslt  = iorslt,
+                   sibsvec = sibsvec)
+
+    def dis_sibsvec(self, addr, count, name, out = None):
+        if self.memusage.get(addr) is None:
+            self.memusage[addr] = ['sibsvec', count]
+        else:
+            assert self.memusage[addr][0] == 'sibsvec'
+            count = self.memusage[addr][1]
+
+        sibsvec = [0] * count
+        for i in range(count):
+            sibsvec[i] = self.get_word(addr + i, name + '[%d]' % i, out)
+        return sibsvec
+
+    # AOS track 0 bootstrap seems to only use a three-word SIB entry
+    def dis_sib(self, addr, name, short = False, out = None):
+        if self.memusage.get(addr) is None:
+            self.memusage[addr] = ['sib', 3 if short else 6]
+        else:
+            assert self.memusage[addr][0] == 'sib'
+            short = self.memusage[addr][1] == 3
+
+        segbase = self.get_word(addr + 0, name + '.segbase', out)
+        segleng = self.get_word(addr + 1, name + '.segleng', out)
+        if not short:
+            segrefs = self.get_word(addr + 2, name + '.segrefs', out)
+            segaddr = self.get_word(addr + 3, name + '.segaddr', out)
+            segunit = self.get_word(addr + 4, name + '.segunit', out)
+            prevsp  = self.get_word(addr + 5, name + '.prevsp',  out)
+        else:
+            unknown = self.get_word(addr + 2, name + '.segunk', out)
+            segrefs = None
+            segaddr = None
+            segunit = None
+            prevsp  = None
+        return SIB(segbase = segbase,
+                   segleng = segleng,
+                   segrefs = segrefs,
+                   segaddr = segaddr,
+                   segunit = segunit,
+                   prevsp  = prevsp)
+
+    def dis_case(self, seg_base, seg_name, proc_name, table_offset, jump_offset, name, out = None):
+        if self.memusage.get(seg_base + table_offset) is None:
+            first = self.get_word(seg_base + table_offset + 0, name + '.min')
+            last  = self.get_word(seg_base + table_offset + 1, name + '.max')
+            count = last + 1 - first
+            self.memusage[seg_base + table_offset] = ['case', count + 2, proc_name, jump_offset, name]
+            print('%04x' % (seg_base + table_offset), self.memusage[seg_base + table_offset], file = self.log)
+        else:
+            assert self.memusage[seg_base + table_offset][0] == 'case'
+            if proc_name is None:
+                proc_name = self.memusage[seg_base + table_offset][2]
+            if jump_offset is None:
+                jump_offset = self.memusage[seg_base + table_offset][3]
+            if name is None:
+                name = self.memusage[seg_base + table_offset][4]
+            first = self.get_word(seg_base + table_offset + 0, name + '.min')
+            last  = self.get_word(seg_base + table_offset + 1, name + '.max')
+            count = last + 1 - first
+
+        offsets = [None] * count
+        for i in range(count):
+            t = self.get_word(seg_base + table_offset + 2 + i, name+'.idx%04x' % (first + i)) + jump_offset
+            offsets[i] = t
+        if out is not None:
+            addr = seg_base + table_offset
+            out.record(CaseTable(addr = addr,
+                                 name = name,
+                                 first = first,
+                                 last = last,
+                                 entries = list(self.mem[addr + 2 : addr + 2 + count]),
+                                 targets = offsets))
+        return offsets
+
+    # Returns the byte offsets of the branch targets of an instruction.
+    # Case tables are recorded in memusage as they are found.
+    def inst_targets(self, seg_base, proc_name, byte_offset, entry, length, parms):
+        targets = ()
+        for opnd, parm in zip(entry.operands, parms):
+            if opnd.render == 'case':
+                targets = self.dis_case(seg_base, None, proc_name, parm, byte_offset + length, proc_name + '.case_%04x' % byte_offset, out = None)
+            elif opnd.render == 'code':
+                targets = (byte_offset + length + parm,)
+        return targets
+
+    # The text of an instruction that has operands, with its branch target
+    # labels from proc_labels, a dict of label by byte offset.
+    def format_inst(self, seg_name, proc_labels, byte_offset, entry, length, parms):
+        args = []
+        for opnd, parm in zip(entry.operands, parms):
+            if opnd.render == 'code':
+                t = byte_offset + length + parm
+                args += [proc_labels[t], seg_name, t]
+            elif opnd.render != 'case':
+                args.append(parm)
+        return entry.fmt % tuple(args)
+
+    # Record the accesses to global and local variables made by an
+    # instruction in var_refs.  This is only done when cross references
+    # are to be listed.
+    def add_var_refs(self, seg_base, proc_name, byte_offset, entry, parms):
+        if entry.operands:
+            operands = zip((opnd.render for opnd in entry.operands), parms)
+        else:
+            operands = zip(entry.imm_renders, entry.imm_operands)
+        for render, value in operands:
+            if render == 'global':
+                scope = None
+            elif render == 'local':
+                scope = proc_name
             else:
-                s = s + ' %d' % parm
-            have_parm = 0
-            for k in flags:
-                flags[k] = False
-
-    if file is not None:
-        print("%s:" % get_byte_offset_addr_str(seg_base, seg_name, byte_offset, proc_name),
-              end = '', file = file)
-        for i in range(4):
-            if i < len(ibytes):
-                print(" %02x" % ibytes[i], end = '', file = file)
+                continue
+            site = XrefSite(proc_name, byte_offset, entry.mnem)
+            self.var_refs.setdefault((seg_base, scope), {}).setdefault('%s_%d' % (render, value), []).append(site)
+
+    def render_inst(self, seg_base, seg_name, proc_name, inst, out):
+        pos = seg_base * 2 + inst.byte_offset
+        out.record(Instruction(seg_base,
+                               seg_name,
+                               proc_name,
+                               inst.byte_offset,
+                               bytes(self.mem_bytes[pos : pos + inst.length]),
+                               self.labels.get(pos),
+                               inst.entry.mnem,
+                               list(inst.operands or inst.entry.imm_operands),
+                               [t for t, label in inst.labels],
+                               inst.text))
+
+    # Returns the successors of the instruction at byte_offset, as a list of
+    # (target byte offset, kind), or None if it isn't a control transfer
+    # and just falls through.  Unlike inst_targets, this records nothing
+    # in memusage, so it can be used without affecting the listing.
+    def inst_succs(self, seg_base, byte_offset, entry, length, parms):
+        mnem = entry.mnem
+        next_offset = byte_offset + length
+        if mnem in returns:
+            return []
+        if mnem in unconditional_jumps:
+            return [(next_offset + parms[0], 'jump')]
+        if mnem in conditional_jumps:
+            return [(next_offset + parms[0], 'branch'), (next_offset, 'fall')]
+        if mnem in case_jumps:
+            succs = []
+            table = seg_base + parms[0]
+            if table + 1 < self.memory.size:
+                count = self.mem[table + 1] + 1 - self.mem[table]
+                if 0 < count <= self.memory.size - (table + 2):
+                    for i in range(count):
+                        t = self.mem[table + 2 + i] + next_offset
+                        if (t, 'case') not in succs:
+                            succs.append((t, 'case'))
+            succs.append((next_offset, 'fall'))
+            return succs
+        return None
+
+    # Returns the control flow graph of the procedure at proc_offset of the
+    # segment at seg_base, building it by recursive descent from the entry
+    # point the first time it is asked for.  Only targets within the
+    # procedure's code are followed; edges to any others are kept as
+    # 'exit' edges.
+    def proc_cfg(self, seg_base, proc_offset, end_offset):
+        key = (seg_base, proc_offset, end_offset)
+        cfg = self.cfgs.get(key)
+        if cfg is not None:
+            return cfg
+
+        code = self.mem_bytes
+        start = proc_offset * 2 + 2
+        insts = {}    # byte offset -> (length, succs)
+        leaders = set([start])
+        work = [start]
+        while work:
+            byte_offset = work.pop()
+            while start <= byte_offset <= end_offset and byte_offset not in insts:
+                entry, length, parms = decode_inst(code, seg_base * 2 + byte_offset)
+                succs = self.inst_succs(seg_base, byte_offset, entry, length, parms)
+                if succs is None:
+                    insts[byte_offset] = (length, succs)
+                    byte_offset += length
+                    continue
+                succs = [(t, kind) if start <= t <= end_offset else (t, 'exit') for t, kind in succs]
+                insts[byte_offset] = (length, succs)
+                for t, kind in succs:
+                    if kind != 'exit':
+                        leaders.add(t)
+                        work.append(t)
+                break
+
+        inst_offsets = sorted(insts)
+        # An instruction that falls into another that has already been
+        # decoded, other than the next one in address order, starts a block.
+        for i, byte_offset in enumerate(inst_offsets):
+            next_offset = byte_offset + insts[byte_offset][0]
+            if next_offset in insts and (i + 1 == len(inst_offsets) or inst_offsets[i + 1] != next_offset):
+                leaders.add(next_offset)
+
+        blocks = {}
+        block_start = None
+        for i, byte_offset in enumerate(inst_offsets):
+            if block_start is None:
+                block_start = byte_offset
+            length, succs = insts[byte_offset]
+            next_offset = byte_offset + length
+            if (succs is None and next_offset in insts and next_offset not in leaders and
+                i + 1 < len(inst_offsets) and inst_offsets[i + 1] == next_offset):
+                continue
+            if succs is None:
+                succs = [(next_offset, 'fall')] if next_offset in insts else []
+            blocks[block_start] = BasicBlock(block_start, next_offset, byte_offset, tuple(succs))
+            block_start = None
+
+        unreachable = []
+        covered = start
+        for byte_offset in inst_offsets:
+            if byte_offset > covered:
+                unreachable.append((covered, byte_offset))
+            covered = max(covered, byte_offset + insts[byte_offset][0])
+        if covered <= end_offset:
+            unreachable.append((covered, end_offset + 1))
+
+        cfg = ProcCFG(start, end_offset, blocks, inst_offsets, unreachable)
+        self.cfgs[key] = cfg
+        return cfg
+
+    def add_call(self, proc_name, byte_offset, entry, parms):
+        seg_num = None
+        target_proc = None
+        for opnd, parm in zip(entry.operands, parms):
+            if opnd.render == 'segment':
+                seg_num = parm
+            elif opnd.render == 'proc':
+                target_proc = parm
+        self.calls.append(CallSite(proc_name, byte_offset, entry.mnem, seg_num, target_proc))
+
+    # List the bytes of a procedure from start up to end as data.
+    def render_gap(self, seg_base, seg_name, proc_name, start, end, out):
+        for byte_offset in range(start, end):
+            self.get_byte_offset(seg_base, seg_name, byte_offset, proc_name, out = out)
+
+    # The instructions of each procedure are decoded once, normally in pass
+    # 1, and recorded in decoded_procs, so pass 2 only has to render the
+    # lines.  Each branch target gets one label, numbered in address
+    # order within the procedure.  The procedure's calls, branch target
+    # references and variable accesses are indexed as it is decoded.
+    def dis_proc(self, seg_num, seg_base, seg_name, proc_name, proc_offset, end_offset = None, out = None):
+        if end_offset is None:
+            end_offset = self.get_word(seg_base + proc_offset - 1, proc_name + '.endoffset')
+            local_size = self.get_word(seg_base + proc_offset + 0, proc_name + '.localsize')
+            if out is not None:
+                out.record(Procedure(seg_base = seg_base,
+                                     seg_name = seg_name,
+                                     proc_name = proc_name,
+                                     proc_offset = proc_offset,
+                                     end_offset = end_offset,
+                                     local_size = local_size))
+        else:
+            local_size = self.get_word(seg_base + proc_offset + 0, proc_name + '.localsize', out)
+        key = (seg_base, proc_offset, end_offset)
+        insts = self.decoded_procs.get(key)
+        if insts is None:
+            insts = self.decode_proc(seg_base, seg_name, proc_name, proc_offset, end_offset)
+            self.decoded_procs[key] = insts
+            if self.stats is not None:
+                self.stats.add_proc(seg_name, proc_name, insts)
+            if self.signatures is not None:
+                name = self.signatures.lookup(proc_fingerprint(insts, local_size, self.mem, seg_base,
+                                                               signature_mask))
+                if name is not None:
+                    self.known_procs[key] = name
+
+        known = self.known_procs.get(key)
+        if known is not None and out is not None:
+            out.record(KnownProc(seg_base, seg_name, proc_name, known, self.skip_known))
+        if known is not None and self.skip_known:
+            byte_offset = max([end_offset + 1] + [inst.byte_offset + inst.length for inst in insts[-1:]])
+            return ((byte_offset + 1) // 2) - (proc_offset - 1)
+
+        byte_offset = proc_offset * 2 + 2
+        for inst in insts:
+            if out is not None:
+                if inst.byte_offset > byte_offset:
+                    self.render_gap(seg_base, seg_name, proc_name, byte_offset, inst.byte_offset, out)
+                self.render_inst(seg_base, seg_name, proc_name, inst, out)
+            if inst.byte_offset + inst.length > byte_offset:
+                byte_offset = inst.byte_offset + inst.length
+        if self.descent and byte_offset <= end_offset:
+            if out is not None:
+                self.render_gap(seg_base, seg_name, proc_name, byte_offset, end_offset + 1, out)
+            byte_offset = end_offset + 1
+        if out is not None and byte_offset & 1:
+            self.get_byte_offset(seg_base, seg_name, byte_offset, proc_name, out = out)
+            byte_offset += 1
+        if out is not None and self.cfg:
+            cfg = self.proc_cfg(seg_base, proc_offset, end_offset)
+            out.record(ControlFlow(seg_base, seg_name, proc_name, cfg.entry,
+                                   list(cfg.blocks.values()), cfg.unreachable))
+        if out is not None and self.xref:
+            self.record_proc_xrefs(seg_base, seg_name, proc_name, insts, out)
+        return (byte_offset // 2) - (proc_offset - 1)
+
+    # Decode the instructions of a procedure, all of them from the start of
+    # its code, or in descent mode only those that are reachable, and
+    # return a list of DecodedInst.
+    def decode_proc(self, seg_base, seg_name, proc_name, proc_offset, end_offset):
+        decoded = []
+        byte_offset = proc_offset * 2 + 2
+        if self.descent:
+            # decode only the reachable instructions, in address order
+            reachable = iter(self.proc_cfg(seg_base, proc_offset, end_offset).inst_offsets)
+            byte_offset = next(reachable, end_offset + 1)
+        code = self.mem_bytes
+        base = seg_base * 2
+        xref = self.xref
+        targets = set()
+        while byte_offset <= end_offset:
+            entry, length, parms = decode_inst(code, base + byte_offset)
+            inst_targets = ()
+            if entry.operands:
+                inst_targets = self.inst_targets(seg_base, proc_name, byte_offset, entry, length, parms)
+                if inst_targets:
+                    targets.update(inst_targets)
+                    for t in inst_targets:
+                        site = XrefSite(proc_name, byte_offset, entry.mnem)
+                        self.label_refs.setdefault(base + t, []).append(site)
+                if entry.mnem in call_insts:
+                    self.add_call(proc_name, byte_offset, entry, parms)
+            if xref and (entry.operands or entry.imm_renders):
+                self.add_var_refs(seg_base, proc_name, byte_offset, entry, parms)
+            decoded.append((byte_offset, entry, length, parms, inst_targets))
+            if self.descent:
+                byte_offset = next(reachable, end_offset + 1)
             else:
-                print("   ", end = '', file = file)
-        label = labels[seg_base * 2 + byte_offset]
-        if label is not None:
-            print("%-19s " % (label + ':'), end = '', file = file)
+                byte_offset += length
+
+        proc_labels = {}
+        for t in sorted(targets):
+            label = '%s.%s.%02x' % (seg_name, proc_name, len(proc_labels))
+            proc_labels[t] = label
+            self.add_label(seg_base, t, label)
+
+        return [DecodedInst(byte_offset, length, entry, parms,
+                            self.format_inst(seg_name, proc_labels, byte_offset, entry, length, parms)
+                            if entry.operands else entry.fmt,
+                            tuple((t, proc_labels[t]) for t in inst_targets) if inst_targets else ())
+                for byte_offset, entry, length, parms, inst_targets in decoded]
+
+    # Record the cross references of a procedure: the sites that refer to
+    # each of its labels, and those that access each of its local
+    # variables.
+    def record_proc_xrefs(self, seg_base, seg_name, proc_name, insts, out):
+        proc_labels = dict(label for inst in insts for label in inst.labels)
+        for t in sorted(proc_labels):
+            sites = self.label_refs.get(seg_base * 2 + t, [])
+            out.record(Xref(seg_base, seg_name, proc_name, proc_labels[t], sites))
+        self.record_var_xrefs(seg_base, seg_name, proc_name, out)
+
+    def record_var_xrefs(self, seg_base, seg_name, scope, out):
+        variables = self.var_refs.get((seg_base, scope), {})
+        for name in sorted(variables, key = lambda name: int(name.rsplit('_', 1)[1])):
+            out.record(Xref(seg_base, seg_name, scope, name, variables[name]))
+
+    # Returns the number of data words, starting at addr and before
+    # end_addr, that can be listed as a single fill line, or 1 if there
+    # aren't enough of them.
+    def data_run(self, addr, end_addr):
+        if self.fill is None:
+            return 1
+        value = self.mem[addr]
+        end = addr + 1
+        while (end < end_addr and self.mem[end] == value
+               and self.memusage.get(end) is None):
+            end += 1
+        count = end - addr
+        return count if count >= self.fill else 1
+
+    def dis_seg_nonproc(self, seg_num, seg_base, seg_name, word_offset, out = None, end_offset = None):
+        usage = self.memusage.get(seg_base + word_offset)
+        if (usage is not None) and (usage[0] == 'case'):
+            self.dis_case(seg_base, seg_name, None, word_offset, None, None, out = out)
+        elif out is not None and end_offset is not None:
+            addr = seg_base + word_offset
+            count = self.data_run(addr, seg_base + end_offset)
+            if count > 1:
+                out.record(DataFill(addr, count, self.mem[addr]))
+                return count
+            self.get_word(addr, '', out = out)
         else:
-            print("                    ", end = '', file = file)
-        print("%s" % s, file = file)
-
-    return len(ibytes)
-
-def dis_proc(seg_num, seg_base, seg_name, proc_name, proc_offset, end_offset = None, file = None):
-    global next_label_num
-    next_label_num = 0
-    if end_offset is None:
-        end_offset = get_word(seg_base + proc_offset - 1, proc_name + '.endoffset', file)
-    local_size = get_word(seg_base + proc_offset + 0, proc_name + '.localsize', file)
-    byte_offset = proc_offset * 2 + 2
-    while byte_offset <= end_offset:
-        byte_offset += dis_inst(seg_num, seg_base, seg_name,
-                                proc_name, byte_offset, file = file)
-    if file is not None and byte_offset & 1:
-        get_byte_offset(seg_base, seg_name, byte_offset, proc_name, file = file)
-        byte_offset += 1
-    return (byte_offset // 2) - (proc_offset - 1)
-
-def dis_seg_nonproc(seg_num, seg_base, seg_name, word_offset, file = None):
-    usage = memusage[seg_base + word_offset]
-    if (usage is not None) and (usage[0] == 'case'):
-        dis_case(seg_base, seg_name, None, word_offset, None, None, file = file)
-    else:
-        get_word(seg_base + word_offset, '', file = file)
-    return 1
+            self.get_word(seg_base + word_offset, '', out = out)
+        return 1
 
-def dis_seg(seg_num, seg_base, seg_length, seg_name, file = None):
-    if memusage[seg_base] is None:
-        memusage[seg_base] = ['segment', seg_length, seg_num, seg_name]
-    else:
-        assert memusage[seg_base][0] == 'segment'
-    
-    proc_dir_offset = get_word(seg_base, seg_name + '.procdir', file = file)
-    if file is not None:
-        print(file = file)
-
-    if proc_dir_offset != seg_length - 1:
-        print('segment length %04x, proc dir offset %04x' % (seg_length, proc_dir_offset), file = file)
-    proc_dir = seg_base + proc_dir_offset
-    seg_num = get_byte(proc_dir + 0, seg_name + '.segnum', False, file = None)
-    num_proc = get_byte(proc_dir + 0, seg_name + '.numproc', True, file = None)
-    proc_offset = [0] * (num_proc + 1)
-    for i in range(num_proc, 0, -1):
-        proc_offset[i] = get_word(proc_dir - i, seg_name + '.proc%d_offset' % i, file = None)
-
-    proc_by_offset = {}
-    for i in range(1, num_proc + 1):
-        proc_by_offset[proc_offset[i]] = i
-
-    next_offset = 1
-    for po in sorted(proc_by_offset.keys()):
-        p = proc_by_offset[po]
-        #print("po %04x, next_offset %04x" % (po, next_offset), file = file)
-        while (po - 1) > next_offset:
-            #print("other at offset %04x" % next_offset, file = file)
-            next_offset += dis_seg_nonproc(seg_num, seg_base, seg_name, next_offset, file = file)
+    def dis_seg(self, seg_num, seg_base, seg_length, seg_name, out = None):
+        if self.memusage.get(seg_base) is None:
+            self.memusage[seg_base] = ['segment', seg_length, seg_num, seg_name]
         else:
-            next_offset += dis_proc(seg_num, seg_base, seg_name, 'proc%d' % p, po, file = file)
-        if file is not None:
-            print(file = file)
-    while next_offset < seg_length:
-        #print("other at offset %04x" % next_offset, file = file)
-        next_offset += dis_seg_nonproc(seg_num, seg_base, seg_name, next_offset, file)
-
-    if file is not None:
+            assert self.memusage[seg_base][0] == 'segment'
+
+        proc_dir_offset = self.get_word(seg_base, seg_name + '.procdir')
+        if out is not None:
+            out.record(SegmentHeader(seg_num = seg_num,
+                                     seg_base = seg_base,
+                                     seg_length = seg_length,
+                                     seg_name = seg_name,
+                                     proc_dir_offset = proc_dir_offset))
+
+        if proc_dir_offset != seg_length - 1:
+            message = 'segment length %04x, proc dir offset %04x' % (seg_length, proc_dir_offset)
+            if out is not None:
+                out.record(Message(message))
+            else:
+                print(message, file = self.log)
+        proc_dir = seg_base + proc_dir_offset
+        seg_num = self.get_byte(proc_dir + 0, seg_name + '.segnum', False, out = None)
+        num_proc = self.get_byte(proc_dir + 0, seg_name + '.numproc', True, out = None)
+        proc_offset = [0] * (num_proc + 1)
         for i in range(num_proc, 0, -1):
-            get_word(proc_dir - i, seg_name + '.proc%d_offset' % i, file)
-        get_byte(proc_dir + 0, seg_name + '.segnum', False, file = file)
-        get_byte(proc_dir + 0, seg_name + '.numproc', True, file = file)
-        print(file = file)
-
-def pass_1_rom(seg_count):
-    boot_param_addr = dis_boot_param_pointer(image_base, 'boot', file = None)
-
-    boot_params = dis_boot_params(boot_param_addr, 'boot', file = None)
-    ctp_addr = boot_params.ctp
-
-    tib = dis_tib(ctp_addr, 'tib', file = None)
-
-    sys_seg = dis_sibsvec(boot_params.sdp, seg_count, 'sdp', file = None)
-
-    for i in range(len(sys_seg)):
-        if sys_seg[i] != 0 and sys_seg[i] != nil:
-            sib = dis_sib(sys_seg[i], 'sib%d' % i, file = None)
-            if sib.segbase != 0 and sib.segbase != nil:
-                dis_seg(i, sib.segbase, sib.segleng, 'seg%d' % i, file = None)
-        
-def pass_1_wdboot(seg_count):
-    boot_param_addr = 0
-
-    boot_params = dis_boot_params(boot_param_addr, 'boot', file = None)
-    ctp_addr = boot_params.ctp
-
-    tib = dis_tib(ctp_addr, 'tib', file = None)
-
-    sys_seg = dis_sibsvec(boot_params.sdp, seg_count, 'sdp', file = None)
-
-    for i in range(len(sys_seg)):
-        if sys_seg[i] != 0 and sys_seg[i] != nil:
-            sib = dis_sib(sys_seg[i], 'sib%d' % i, file = None)
-            if sib.segbase != 0 and sib.segbase != nil:
-                dis_seg(i, sib.segbase, sib.segleng, 'seg%d' % i, file = None)
-        
-def pass_1_acdboot(seg_count):
-    ctp_addr = 0x2000
-    seg_base = 0x200c
-    seg_length = mem[seg_base] + 1
-
-    tib = dis_tib(ctp_addr, 'tib', file = None)
-
-    dis_seg(1, seg_base, seg_length, 'boot', file = None)
-        
-
-def pass_2(file):
-    global image_base, image_len
-    addr = image_base
-    while addr < image_base + image_len:
-        usage = memusage[addr]
-        if usage is None:
-            get_word(addr, '', file = file)
-            usage = (None, 1)
-        elif usage[0] == 'boot_param_pointer':
-            dis_boot_param_pointer(addr, 'boot', file = file)
-        elif usage[0] == 'boot_params':
-            dis_boot_params(addr, 'boot', file = file)
-        elif usage[0] == 'tib':
-            dis_tib(addr, 'tib', file = file)
-        elif usage[0] == 'sibsvec':
-            dis_sibsvec(addr, 2, 'sdp', file = file)
-        elif usage[0] == 'sib':
-            dis_sib(addr, 'sib', file = file)
-        elif usage[0] == 'segment':
-            dis_seg(seg_num    = usage[2],
-                    seg_base   = addr,
-                    seg_length = usage[1],
-                    seg_name   = usage[3],
-                    file = file)
-        else:
-            raise Exception("invalid memory usage entry " + str(usage))
-        print(file = file)
-        addr += usage[1]
+            proc_offset[i] = self.get_word(proc_dir - i, seg_name + '.proc%d_offset' % i, out = None)
+
+        proc_by_offset = {}
+        for i in range(1, num_proc + 1):
+            proc_by_offset[proc_offset[i]] = i
+
+        # When only some procedures are selected, nothing else in the
+        # segment has been loaded, so only they are disassembled, each with
+        # the words following it, such as its case tables, up to the next
+        # procedure or the procedure dictionary.
+        if self.procs is not None:
+            starts = sorted(proc_by_offset.keys())
+            ends = [po - 1 for po in starts[1:]] + [proc_dir_offset - num_proc]
+            for po, end in zip(starts, ends):
+                p = proc_by_offset[po]
+                if p in self.procs:
+                    next_offset = po - 1 + self.dis_proc(seg_num, seg_base, seg_name, 'proc%d' % p, po, out = out)
+                    if out is not None:
+                        out.blank()
+                    trailing = next_offset < end
+                    while next_offset < end:
+                        next_offset += self.dis_seg_nonproc(seg_num, seg_base, seg_name, next_offset, out = out, end_offset = end)
+                    if out is not None and trailing:
+                        out.blank()
+            if out is not None and self.xref:
+                self.record_var_xrefs(seg_base, seg_name, None, out)
+            return
+
+        next_offset = 1
+        for po in sorted(proc_by_offset.keys()):
+            p = proc_by_offset[po]
+            #print("po %04x, next_offset %04x" % (po, next_offset), file = file)
+            while (po - 1) > next_offset:
+                #print("other at offset %04x" % next_offset, file = file)
+                next_offset += self.dis_seg_nonproc(seg_num, seg_base, seg_name, next_offset, out = out, end_offset = po - 1)
+            else:
+                next_offset += self.dis_proc(seg_num, seg_base, seg_name, 'proc%d' % p, po, out = out)
+            if out is not None:
+                out.blank()
+        while next_offset < seg_length:
+            #print("other at offset %04x" % next_offset, file = file)
+            next_offset += self.dis_seg_nonproc(seg_num, seg_base, seg_name, next_offset, out, seg_length)
+
+        if out is not None:
+            for i in range(num_proc, 0, -1):
+                self.get_word(proc_dir - i, seg_name + '.proc%d_offset' % i, out)
+            self.get_byte(proc_dir + 0, seg_name + '.segnum', False, out = out)
+            self.get_byte(proc_dir + 0, seg_name + '.numproc', True, out = out)
+            out.blank()
+            if self.xref:
+                self.record_var_xrefs(seg_base, seg_name, None, out)
+
+    def pass_1_rom(self, seg_count):
+        boot_param_addr = self.dis_boot_param_pointer(self.image_base, 'boot', out = None)
+
+        boot_params = self.dis_boot_params(boot_param_addr, 'boot', out = None)
+        ctp_addr = boot_params.ctp
+
+        tib = self.dis_tib(ctp_addr, 'tib', out = None)
+
+        sys_seg = self.dis_sibsvec(boot_params.sdp, seg_count, 'sdp', out = None)
+
+        for i in range(len(sys_seg)):
+            if sys_seg[i] != 0 and sys_seg[i] != nil:
+                sib = self.dis_sib(sys_seg[i], 'sib%d' % i, out = None)
+                if sib.segbase != 0 and sib.segbase != nil:
+                    self.dis_seg(i, sib.segbase, sib.segleng, 'seg%d' % i, out = None)
+
+    def pass_1_wdboot(self, seg_count):
+        boot_param_addr = 0
+
+        boot_params = self.dis_boot_params(boot_param_addr, 'boot', out = None)
+        ctp_addr = boot_params.ctp
+
+        tib = self.dis_tib(ctp_addr, 'tib', out = None)
+
+        sys_seg = self.dis_sibsvec(boot_params.sdp, seg_count, 'sdp', out = None)
+
+        for i in range(len(sys_seg)):
+            if sys_seg[i] != 0 and sys_seg[i] != nil:
+                sib = self.dis_sib(sys_seg[i], 'sib%d' % i, out = None)
+                if sib.segbase != 0 and sib.segbase != nil:
+                    self.dis_seg(i, sib.segbase, sib.segleng, 'seg%d' % i, out = None)
+
+    def pass_1_acdboot(self, seg_count):
+        ctp_addr = 0x2000
+        seg_base = 0x200c
+        seg_length = self.mem[seg_base] + 1
+
+        tib = self.dis_tib(ctp_addr, 'tib', out = None)
+
+        self.dis_seg(1, seg_base, seg_length, 'boot', out = None)
+
+
+    def pass_2(self, out):
+        addr = self.image_base
+        while addr < self.image_base + self.image_len:
+            usage = self.memusage.get(addr)
+            if usage is None:
+                count = self.data_run(addr, self.image_base + self.image_len)
+                if count > 1:
+                    out.record(DataFill(addr, count, self.mem[addr]))
+                else:
+                    self.get_word(addr, '', out = out)
+                usage = (None, count)
+            elif usage[0] == 'boot_param_pointer':
+                self.dis_boot_param_pointer(addr, 'boot', out = out)
+            elif usage[0] == 'boot_params':
+                self.dis_boot_params(addr, 'boot', out = out)
+            elif usage[0] == 'tib':
+                self.dis_tib(addr, 'tib', out = out)
+            elif usage[0] == 'sibsvec':
+                self.dis_sibsvec(addr, 2, 'sdp', out = out)
+            elif usage[0] == 'sib':
+                self.dis_sib(addr, 'sib', out = out)
+            elif usage[0] == 'segment':
+                self.dis_seg(seg_num    = usage[2],
+                        seg_base   = addr,
+                        seg_length = usage[1],
+                        seg_name   = usage[3],
+                        out = out)
+            else:
+                raise Exception("invalid memory usage entry " + str(usage))
+            out.blank()
+            addr += usage[1]
+        out.flush()
 
 
 def get8(b, offset):
@@ -691,7 +1541,9 @@ SegInfo = collections.namedtuple('SegInfo', ['block',
                                              'segnum',
                                              'codeversion'])
 
-def get_code_seg_info(seg_page, rel_seg_num):
+# Segment directory entry rel_seg_num of a directory page, whose first
+# entry is segment first_seg_num.
+def get_code_seg_info(seg_page, rel_seg_num, first_seg_num = 0):
     block = get16(seg_page, rel_seg_num * 4)
     length = get16(seg_page, rel_seg_num * 4 + 2)
     name = getalpha(seg_page, 0x040 + rel_seg_num * 8)
@@ -704,8 +1556,18 @@ def get_code_seg_info(seg_page, rel_seg_num):
                    name   = name,
                    kind   = kind,
                    addr   = addr,
-                   segnum = rel_seg_num,
+                   segnum = first_seg_num + rel_seg_num,
                    codeversion = codeversion)
+
+# The number of the first segment of a segment directory: 0 for a system
+# code file, whose segments are 0..15, or 128 for a user code file, whose
+# segments are 128..143.  It is taken from the segment number byte of the
+# first entry in use.
+def get_code_first_seg_num(header):
+    for rel_seg_num in range(16):
+        if get16(header, rel_seg_num * 4) != 0:
+            return get8(header, 0x100 + rel_seg_num * 2) & 0x80
+    return 0
     
 BlockInfo = collections.namedtuple('BlockInfo', ['block',
                                                  'block_count',
@@ -713,60 +1575,850 @@ BlockInfo = collections.namedtuple('BlockInfo', ['block',
                                                  'what', # 'code', 'interface'
                                                  'seg_info'])
 
-# AOS uses an entirely different code file header
-# first two bytes of first block are always 0xffff
-# next two bytes are block number of next index block, or 0x0000
-def dis_aos_codefile(cf, header, df):
-    pass  # XXX more code needed here (obviously)
-    
+# Returns the contents of the binary file object f as a buffer, mapping
+# the file into memory if possible.
+def map_file(f):
+    try:
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        f.seek(0)
+        return f.read()
+
+
+# An ImageDisk (.IMD) floppy image.  The file is an ASCII header and
+# comment terminated by 0x1a, followed by the tracks, each of which is
+#   mode, cylinder, head, sector count, sector size code
+#   sector numbering map (one byte per sector)
+#   cylinder map, if bit 7 of head is set
+#   head map, if bit 6 of head is set
+#   sector size table (one word per sector), if the size code is 0xff
+# and then a record for each sector, starting with a type byte:
+#   0            data unavailable, no further bytes
+#   1, 3, 5, 7   normal data follows (with deleted and/or error flags)
+#   2, 4, 6, 8   compressed, a single byte follows that fills the sector
+# The image is indexed in one pass over an mmap of the file, and the
+# sectors are then put in ascending order of cylinder, head and sector
+# number, which maps each block of the volume to a position on the disk.
+# That only holds if the geometry is uniform, every track having the
+# same sectors, all of one size, so images that aren't are rejected.  A
+# block within one normal sector is handed out as a memoryview slice of
+# the image; only a block that spans sectors, or one that is compressed
+# or unavailable, is copied.  Unavailable sectors read as zeros, and are
+# listed in missing.
+ImdSector = collections.namedtuple('ImdSector', ['cylinder', 'head', 'sector', 'size',
+                                                 'type', 'offset'])
+
+class ImageDisk:
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        self.comment = ''
+        self.sectors = []
+        self.missing = []
+        self.index()
+        self.assemble()
+
+    @classmethod
+    def open(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls(map_file(f))
+
+    def index(self):
+        buf = self.buf
+        if bytes(buf[:4]) != b'IMD ':
+            raise ValueError('not an ImageDisk image')
+        pos = bytes(buf[:4096]).find(b'\x1a')
+        if pos < 0:
+            raise ValueError('ImageDisk header not terminated')
+        self.comment = bytes(buf[:pos]).decode('ascii', 'replace')
+        pos += 1
+        while pos < len(buf):
+            if pos + 5 > len(buf):
+                raise ValueError('truncated ImageDisk track header at %x' % pos)
+            mode, cylinder, head, count, size_code = buf[pos : pos + 5]
+            pos += 5
+            sector_map = buf[pos : pos + count]
+            pos += count
+            cylinder_map = [cylinder] * count
+            if head & 0x80:
+                cylinder_map = buf[pos : pos + count]
+                pos += count
+            head_map = [head & 0x0f] * count
+            if head & 0x40:
+                head_map = buf[pos : pos + count]
+                pos += count
+            if size_code == 0xff:
+                sizes = [get16(buf, pos + 2 * i) for i in range(count)]
+                pos += 2 * count
+            elif size_code <= 6:
+                sizes = [128 << size_code] * count
+            else:
+                raise ValueError('bad ImageDisk sector size code %02x' % size_code)
+            for i in range(count):
+                if pos >= len(buf):
+                    raise ValueError('truncated ImageDisk sector at %x' % pos)
+                t = buf[pos]
+                pos += 1
+                if t > 8:
+                    raise ValueError('bad ImageDisk sector type %02x at %x' % (t, pos - 1))
+                self.sectors.append(ImdSector(cylinder_map[i], head_map[i], sector_map[i],
+                                              sizes[i], t, pos))
+                if t == 0:
+                    pass
+                elif t & 1:
+                    pos += sizes[i]
+                else:
+                    pos += 1
+            if pos > len(buf):
+                raise ValueError('truncated ImageDisk image')
+
+    def assemble(self):
+        self.sectors.sort(key = lambda s: (s.cylinder, s.head, s.sector))
+        if not self.sectors:
+            raise ValueError('ImageDisk image has no sectors')
+        tracks = {}
+        for s in self.sectors:
+            tracks.setdefault((s.cylinder, s.head), []).append(s.sector)
+        first_track = min(tracks)
+        track_sectors = tracks[first_track]
+        if len(set(track_sectors)) != len(track_sectors):
+            raise ValueError('ImageDisk track at cylinder %d head %d has duplicate sectors' % first_track)
+        for (cylinder, head), sectors in sorted(tracks.items()):
+            if sectors != track_sectors:
+                raise ValueError('ImageDisk geometry is not uniform: cylinder %d head %d has sectors %s, not %s'
+                                 % (cylinder, head, ' '.join(map(str, sectors)), ' '.join(map(str, track_sectors))))
+        # only the last cylinder may be missing tracks
+        heads = sorted(set(head for cylinder, head in tracks))
+        positions = [(first_track[0] + i // len(heads), heads[i % len(heads)]) for i in range(len(tracks))]
+        for position, (cylinder, head) in zip(positions, sorted(tracks)):
+            if (cylinder, head) != position:
+                raise ValueError('ImageDisk geometry is not uniform: cylinder %d head %d is missing' % position)
+        self.sector_size = self.sectors[0].size
+        for s in self.sectors:
+            if s.size != self.sector_size:
+                raise ValueError('ImageDisk geometry is not uniform: cylinder %d head %d sector %d is %d bytes, not %d'
+                                 % (s.cylinder, s.head, s.sector, s.size, self.sector_size))
+        # each sector's data, a slice of the image, or the byte that fills
+        # a compressed or unavailable sector
+        self.sector_data = []
+        for s in self.sectors:
+            if s.type == 0:
+                self.missing.append(s)
+                self.sector_data.append(0)
+            elif s.type & 1:
+                self.sector_data.append(self.buf[s.offset : s.offset + s.size])
+            else:
+                self.sector_data.append(self.buf[s.offset])
+        self.size = len(self.sectors) * self.sector_size
+
+    def blocks(self, block, count = None):
+        size = self.sector_size
+        start = min(block * 512, self.size)
+        end = self.size if count is None else min((block + count) * 512, self.size)
+        if start >= end:
+            return memoryview(b'')
+        first = start // size
+        if end <= (first + 1) * size and not isinstance(self.sector_data[first], int):
+            return self.sector_data[first][start - first * size : end - first * size]
+        data = bytearray(end - start)
+        for i in range(first, (end + size - 1) // size):
+            lo = max(start, i * size)
+            hi = min(end, (i + 1) * size)
+            sector = self.sector_data[i]
+            if isinstance(sector, int):
+                data[lo - start : hi - start] = bytes([sector]) * (hi - lo)
+            else:
+                data[lo - start : hi - start] = sector[lo - i * size : hi - i * size]
+        return memoryview(data)
+
+
+# A volume image file, such as a .vol or .dsk dump of a disk, which hands
+# out blocks as memoryview slices of an mmap of the file, as an ImageDisk
+# does.
+class VolumeImage:
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+
+    @classmethod
+    def open(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls(map_file(f))
+
+    def blocks(self, block, count = None):
+        if count is None:
+            return self.buf[block * 512 :]
+        return self.buf[block * 512 : (block + count) * 512]
+
+
+# A p-System volume on a disk image, a VolumeImage or an ImageDisk, read
+# through the image's blocks method.  The directory is in blocks
+# 2 through 5, as an array of 26 byte entries.  Entry 0 describes the
+# volume:
+#   0x00  first block (0)
+#   0x02  last block + 1 of the directory (6)
+#   0x04  file kind (0)
+#   0x06  volume name, string[7]
+#   0x0e  number of blocks in the volume
+#   0x10  number of files
+#   0x12  load time
+#   0x14  date last set
+# and the remaining entries describe the files:
+#   0x00  first block
+#   0x02  last block + 1
+#   0x04  file kind in the low four bits
+#   0x06  file name, string[15]
+#   0x16  number of bytes used in the last block
+#   0x18  date last modified
+VolumeEntry = collections.namedtuple('VolumeEntry', ['name',
+                                                     'first_block',
+                                                     'last_block',
+                                                     'kind',
+                                                     'last_byte',
+                                                     'date'])
+
+file_kinds = ['untyped', 'badblocks', 'code', 'text', 'info', 'data', 'graf', 'foto', 'securedir']
+
+class PSystemVolume:
+    dir_block = 2
+    entry_size = 26
+
+    def __init__(self, image):
+        self.image = image
+        self.read_directory()
+
+    def get_string(self, d, offset, max_length):
+        length = d[offset]
+        if length > max_length:
+            raise ValueError('bad string length in directory')
+        return bytes(d[offset + 1 : offset + 1 + length]).decode('ascii', 'replace')
+
+    def read_directory(self):
+        d = bytes(self.image.blocks(self.dir_block, 4))
+        if len(d) < 2048:
+            raise ValueError('image too short for a p-System directory')
+        if get16(d, 0x00) != 0 or get16(d, 0x02) != 6:
+            raise ValueError('no p-System directory')
+        self.name = self.get_string(d, 0x06, 7)
+        self.num_blocks = get16(d, 0x0e)
+        num_files = get16(d, 0x10)
+        if not self.name or num_files > 2048 // self.entry_size - 1:
+            raise ValueError('no p-System directory')
+        self.entries = []
+        for i in range(1, num_files + 1):
+            e = d[i * self.entry_size : (i + 1) * self.entry_size]
+            entry = VolumeEntry(name = self.get_string(e, 0x06, 15),
+                                first_block = get16(e, 0x00),
+                                last_block = get16(e, 0x02),
+                                kind = get16(e, 0x04) & 0x0f,
+                                last_byte = get16(e, 0x16),
+                                date = get16(e, 0x18))
+            if not 6 <= entry.first_block <= entry.last_block:
+                raise ValueError('bad directory entry for %s' % entry.name)
+            self.entries.append(entry)
+        self.entries.sort(key = lambda e: e.first_block)
+
+    # Returns the entries, in block order, whose names match any of the
+    # glob patterns, ignoring case.
+    def find(self, patterns):
+        return [e for e in self.entries
+                if any(fnmatch.fnmatchcase(e.name.upper(), p.upper()) for p in patterns)]
+
+    def file_data(self, entry):
+        return self.image.blocks(entry.first_block, entry.last_block - entry.first_block)
+
+    def print_directory(self, file = None):
+        months = ['???', 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                  'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec', '???', '???', '???']
+        print('%s: %d files, %d blocks' % (self.name, len(self.entries), self.num_blocks), file = file)
+        for e in self.entries:
+            if e.kind < len(file_kinds):
+                kind = file_kinds[e.kind]
+            else:
+                kind = str(e.kind)
+            date = '%2d-%s-%02d' % ((e.date >> 4) & 0x1f, months[e.date & 0x0f], e.date >> 9)
+            print('%-15s %5d %5d-%5d %-9s %s' % (e.name, e.last_block - e.first_block,
+                                                 e.first_block, e.last_block - 1, kind, date),
+                  file = file)
+
+
+# A persistent cache of the results of disassembling code segments, kept
+# as one file per segment in a directory.  Entries are keyed by a hash of
+# the segment's contents together with everything else that affects the
+# results: the source of this program, the output options, and the
+# segment's name and number, which appear in the listing.  Each entry
+# holds the diagnostic messages, the listing text and the call sites.  A hit updates the
+# entry's modification time, and when the directory grows beyond
+# max_size bytes the least recently used entries are removed.  Entries
+# are written atomically, so several processes can share a cache.
+class SegmentCache:
+    version = 2
+    suffix = '.seg'
+
+    def __init__(self, directory, max_size = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        with open(__file__, 'rb') as f:
+            self.program_hash = hashlib.sha256(f.read()).hexdigest()
+        os.makedirs(directory, exist_ok = True)
+        self.size = None
+
+    def key(self, seg_num, seg_length, seg_name, data, options):
+        h = hashlib.sha256()
+        h.update(repr((self.version, self.program_hash, options,
+                       seg_num, seg_length, seg_name)).encode())
+        h.update(data)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    # Returns (log_text, listing_text, calls), or None on a miss.
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r', newline = '') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry['log'], entry['listing'], [CallSite(*c) for c in entry['calls']]
+
+    def put(self, key, log_text, listing_text, calls):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w', newline = '') as f:
+            json.dump({ 'log': log_text, 'listing': listing_text, 'calls': calls }, f)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        if self.size is None:
+            self.size = self.disk_size()
+        else:
+            self.size += size
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for fn in filenames:
+                if fn.endswith(self.suffix):
+                    path = os.path.join(dirpath, fn)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield st.st_mtime, st.st_size, path
+
+    def disk_size(self):
+        return sum(size for mtime, size, path in self.entries())
+
+    # Remove least recently used entries until the cache is no more than
+    # three quarters full, so that eviction isn't needed on every put.
+    def evict(self):
+        entries = sorted(self.entries())
+        self.size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if self.size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+
+# A code file, accessed at random through a buffer, normally an mmap of
+# the file, so that reading one segment doesn't read any of the others.
+# The segment directory is parsed when the CodeFile is created.  The
+# entries of an AOS index are only decoded if aos_layout is true, since
+# their layout is a guess.
+class CodeFile:
+    def __init__(self, buf, aos_layout = False):
+        self.buf = memoryview(buf)
+        self.aos_layout = aos_layout
+        if len(self.buf) < 512:
+            raise ValueError('code file is %d bytes, too short for a segment directory' % len(self.buf))
+        self.header = bytes(self.buf[:512])
+        self.aos = get16(self.header, 0) == 0xffff
+        self.seg_info = []
+        self.block_info = {}
+        self.index_block_nums = []
+        if self.aos:
+            self.read_aos_index()
+            if aos_layout:
+                self.read_aos_seg_info()
+        else:
+            self.read_seg_info()
+        self.index_blocks()
+
+    # Open the code file f, which is a file name, a binary file object,
+    # which is mapped into memory if possible, or a buffer.
+    @classmethod
+    def open(cls, f, aos_layout = False):
+        if isinstance(f, str):
+            with open(f, 'rb') as bf:
+                return cls.open(bf, aos_layout)
+        if isinstance(f, (bytes, bytearray, memoryview)):
+            return cls(f, aos_layout)
+        return cls(map_file(f), aos_layout)
+
+    def blocks(self, block, count):
+        return self.buf[block * 512 : (block + count) * 512]
+
+    def read_seg_info(self):
+        header = self.header
+        # traditional p-System code file header
+        base_seg_num = get_code_first_seg_num(header)
+        self.seg_info = [get_code_seg_info(header, i, base_seg_num) for i in range(16)]
+
+        # A vectored code file has more segments than fit in block 0.  The
+        # directory continues in pages of 16 entries, in the same layout as
+        # block 0, in the blocks following the last code block.  last_seg is
+        # the highest segment number in the directory, counting from the
+        # first segment of block 0.
+        code_kind = ['static', 'vectored'][header[0x16f]]
+        if code_kind == 'vectored':
+            last_seg = get16(header, 0x170)
+            last_code_block = get16(header, 0x172)
+            for first_seg_num in range(base_seg_num + 16, last_seg + 1, 16):
+                block = last_code_block + (first_seg_num - base_seg_num) // 16
+                seg_page = self.blocks(block, 1)
+                if len(seg_page) < 512:
+                    raise ValueError('segment directory block %d is past the end of the code file' % block)
+                self.seg_info += [get_code_seg_info(seg_page, i, first_seg_num) for i in range(16)]
+
+    # AOS uses an entirely different code file header
+    # first two bytes of first block are always 0xffff
+    # next two bytes are block number of next index block, or 0x0000
+    # The chain is walked once, and its index blocks are kept.
+    def read_aos_index(self):
+        block = 0
+        while True:
+            if block in self.index_block_nums:
+                raise ValueError('AOS index block chain loops at block %d' % block)
+            index = self.blocks(block, 1)
+            if len(index) < 512 or get16(index, 0) != 0xffff:
+                raise ValueError('bad AOS index block %d' % block)
+            self.index_block_nums.append(block)
+            block = get16(index, 2)
+            if block == 0:
+                break
+
+    # The layout of the rest of an index block isn't documented.  With
+    # aos_layout, it is taken to be 31 entries of 16 bytes each:
+    #   0x00  segment name, 8 characters
+    #   0x08  first block
+    #   0x0a  length in words
+    #   0x0c  segment kind, as in a p-System code file
+    #   0x0e  segment number
+    #   0x0f  code version
+    # where an entry with a first block of 0 is unused.  The entries of
+    # all of the index blocks are kept.  Since the layout is assumed,
+    # each entry is checked to lie within the file, clear of the index
+    # blocks and of the other entries.
+    aos_entry_size = 16
+    aos_entries_per_block = 31
+
+    def read_aos_seg_info(self):
+        for block in self.index_block_nums:
+            index = bytes(self.blocks(block, 1))
+            for i in range(self.aos_entries_per_block):
+                e = 4 + i * self.aos_entry_size
+                si = SegInfo(block = get16(index, e + 0x08),
+                             length = get16(index, e + 0x0a),
+                             name = getalpha(index, e + 0x00),
+                             kind = get16(index, e + 0x0c),
+                             addr = 0,
+                             segnum = get8(index, e + 0x0e),
+                             codeversion = get8(index, e + 0x0f))
+                if si.block != 0:
+                    self.seg_info.append(si)
+        self.check_aos_seg_info()
+
+    def check_aos_seg_info(self):
+        file_blocks = len(self.buf) // 512
+        used = [(block, block + 1, 'AOS index block %d' % block) for block in self.index_block_nums]
+        for si in self.seg_info:
+            what = 'AOS index entry %s at block %d' % (si.name.strip() or 'seg%d' % si.segnum, si.block)
+            end = si.block + (si.length + 255) // 256
+            if si.length == 0 or end > file_blocks:
+                raise ValueError('%s, length %04x, is not within the code file' % (what, si.length))
+            used.append((si.block, end, what))
+        used.sort()
+        for (start1, end1, what1), (start2, end2, what2) in zip(used, used[1:]):
+            if start2 < end1:
+                raise ValueError('%s overlaps %s' % (what2, what1))
+
+    def index_blocks(self):
+        block_info = self.block_info
+        for block in self.index_block_nums[1:]:
+            block_info[block] = BlockInfo(block = block,
+                                          block_count = 1,
+                                          kind = 'aos',
+                                          what = 'index',
+                                          seg_info = None)
+        for i in range(len(self.seg_info)):
+            si = self.seg_info[i]
+            if si.block != 0:
+                if si.kind < 5:
+                    kind = ['linked', 'hostseg', 'segproc', 'unitseg', 'seprtseg'][si.kind]
+                else:
+                    kind = str(si.kind)
+                assert si.block not in block_info
+                block_info[si.block] = BlockInfo(block = si.block,
+                                                 block_count = (si.length + 255) // 256,
+
+                                                 kind = kind,
+                                                 what = 'code',
+                                                 seg_info = si)
+                if kind == 'unitseg':
+                    assert si.addr != 0
+                    assert si.addr not in block_info
+                    block_info[si.addr] = BlockInfo(block = si.addr,
+                                                    block_count = si.block - si.addr,
+                                                    kind = kind,
+                                                    what = 'interface',
+                                                    seg_info = si)
+
+    # the segment directory entries of the code segments, in block order
+    def code_segments(self):
+        return [self.block_info[block].seg_info for block in sorted(self.block_info.keys())
+                if self.block_info[block].what == 'code']
+
+    # Find a code segment by name, ignoring case, or by number.
+    def find_segment(self, spec):
+        for si in self.code_segments():
+            if spec.isdigit():
+                if int(spec) == si.segnum:
+                    return si
+            elif spec.upper() in (si.name.strip().upper(), 'SEG%d' % si.segnum):
+                return si
+        raise KeyError('no segment %s in code file' % spec)
+
+    def segment_data(self, si):
+        return self.blocks(si.block, (si.length + 255) // 256)
+
+
+def seg_info_name(si):
+    seg_name = si.name.strip()
+    if seg_name == '':
+        seg_name = 'seg%d' % si.segnum
+    return seg_name
+
+# The index blocks of an AOS code file are listed, but the layout of the
+# index entries isn't documented, so its segments are only found if the
+# CodeFile was opened with aos_layout.  Their entries have then been read
+# into the same form as a p-System segment directory, so the segments are
+# disassembled the same way, and the listing says that the layout is
+# assumed.
+aos_layout_message = 'AOS code file: the layout of the index entries is assumed, not documented; check the segment list'
+aos_no_layout_message = "AOS code file: the layout of the index entries isn't documented, so no segments are listed; --aos-layout decodes them with an assumed layout"
+
+def dis_aos_codefile(codefile, out, log = None, jobs = 1, options = None, segments = None, procs = None,
+                     cache = None, callgraph = None, stats = None):
+    message = 'AOS index blocks: %s' % ' '.join('%d' % block for block in codefile.index_block_nums)
+    print(message, file = log)
+    out.record(Message(message))
+    if not codefile.aos_layout:
+        print('warning: ' + aos_no_layout_message, file = sys.stderr)
+        out.record(Message(aos_no_layout_message))
+        out.blank()
+        return
+    print('warning: ' + aos_layout_message, file = sys.stderr)
+    out.record(Message(aos_layout_message))
+    out.blank()
+    dis_ucsd_codefile(codefile, out, log, jobs, options, segments, procs, cache, callgraph, stats)
+
+# A call graph of procedures, each named 'segment.procN', built from the
+# call sites found while disassembling.  The segment numbers of external
+# calls are resolved to names through the segment directory of the code
+# file containing the call, and then through those of the library code
+# files, if any.  Edges are indexed in both directions, so callers and
+# callees are found with a dictionary lookup.
+class CallGraph:
+    def __init__(self, libraries = ()):
+        self.library_seg_names = {}
+        for codefile in libraries:
+            for si in codefile.code_segments():
+                self.library_seg_names.setdefault(si.segnum, seg_info_name(si))
+        self.callees_of = {}   # caller -> { callee: [CallSite, ...] }
+        self.callers_of = {}   # callee -> { caller: [CallSite, ...] }
+
+    # The segment names by number for calls from codefile.
+    def seg_names(self, codefile):
+        names = dict(self.library_seg_names)
+        for si in codefile.code_segments():
+            names[si.segnum] = seg_info_name(si)
+        return names
+
+    def add_calls(self, seg_name, calls, seg_names):
+        for site in calls:
+            caller = '%s.%s' % (seg_name, site.proc)
+            if site.seg_num is None:
+                target_seg = seg_name
+            else:
+                target_seg = seg_names.get(site.seg_num, 'seg%d' % site.seg_num)
+            callee = '%s.proc%d' % (target_seg, site.target_proc)
+            self.callees_of.setdefault(caller, {}).setdefault(callee, []).append(site)
+            self.callers_of.setdefault(callee, {}).setdefault(caller, []).append(site)
+
+    def find_node(self, name):
+        for node in itertools.chain(self.callees_of, self.callers_of):
+            if node.upper() == name.upper():
+                return node
+        return name
+
+    def callers(self, node):
+        return sorted(self.callers_of.get(node, ()))
+
+    def callees(self, node):
+        return sorted(self.callees_of.get(node, ()))
+
+    def nodes(self):
+        return sorted(set(self.callees_of) | set(self.callers_of))
+
+    def as_dict(self):
+        return { 'nodes': self.nodes(),
+                 'edges': [{ 'caller': caller,
+                             'callee': callee,
+                             'sites':  [{ 'byte_offset': site.byte_offset,
+                                          'mnem':        site.mnem }
+                                        for site in sites] }
+                           for caller in sorted(self.callees_of)
+                           for callee, sites in sorted(self.callees_of[caller].items())] }
+
+    def write_json(self, file):
+        json.dump(self.as_dict(), file, indent = 2)
+        file.write('\n')
+
+    def write_dot(self, file):
+        lines = ['digraph calls {\n',
+                 '  node [shape=box, fontname="monospace"];\n']
+        for node in self.nodes():
+            lines.append('  "%s";\n' % node)
+        for caller in sorted(self.callees_of):
+            for callee, sites in sorted(self.callees_of[caller].items()):
+                lines.append('  "%s" -> "%s"%s;\n' % (caller, callee,
+                                                     ' [label="%d"]' % len(sites) if len(sites) > 1 else ''))
+        lines.append('}\n')
+        file.write(''.join(lines))
+
+
+# Instrumentation of a run: the wall and CPU time spent in each phase,
+# the instructions decoded in each segment and procedure, and a histogram
+# of their opcodes by mnemonic.  Phases nest, and the time of a phase is
+# charged to it exclusively, with the time of the phases nested within it
+# charged to them instead, so the phase times add up to the time of the
+# run; total_wall includes the nested phases.  Nothing is instrumented
+# unless a Stats is given, so there's no cost otherwise.
+class Stats:
+    def __init__(self):
+        self.phases = {}    # name -> [calls, wall, cpu, total_wall]
+        self.stack = []     # [name, wall at entry]
+        self.segments = {}  # segment name -> { procedure name: [instructions, bytes] }
+        self.opcodes = collections.Counter()
+        self.cached_segments = 0
+        self.memory = None
+        self.start = (time.perf_counter(), time.process_time())
+        self.mark = self.start
+
+    # Charge the time since the last mark to the innermost phase.
+    def charge(self):
+        now = (time.perf_counter(), time.process_time())
+        if self.stack:
+            p = self.phases[self.stack[-1][0]]
+            p[1] += now[0] - self.mark[0]
+            p[2] += now[1] - self.mark[1]
+        self.mark = now
+
+    def enter(self, name):
+        self.charge()
+        p = self.phases.setdefault(name, [0, 0.0, 0.0, 0.0])
+        p[0] += 1
+        self.stack.append([name, self.mark[0]])
+
+    def leave(self):
+        self.charge()
+        name, wall = self.stack.pop()
+        self.phases[name][3] += self.mark[0] - wall
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    # Returns func wrapped so that its calls are timed as phase name.
+    def timed(self, name, func):
+        def wrapper(*args, **kwargs):
+            self.enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.leave()
+        return wrapper
+
+    # Time the output of renderer out as the 'output' phase.
+    def instrument_renderer(self, out):
+        out.record = self.timed('output', out.record)
+        out.blank = self.timed('output', out.blank)
+        out.flush = self.timed('output', out.flush)
+
+    def add_proc(self, seg_name, proc_name, insts):
+        counts = self.segments.setdefault(seg_name, {}).setdefault(proc_name, [0, 0])
+        counts[0] += len(insts)
+        counts[1] += sum(inst.length for inst in insts)
+        self.opcodes.update(inst.entry.mnem for inst in insts)
+
+    def instructions(self):
+        return sum(c[0] for procs in self.segments.values() for c in procs.values())
+
+    def bytes(self):
+        return sum(c[1] for procs in self.segments.values() for c in procs.values())
+
+    # Instruction bytes decoded per second of the time spent decoding,
+    # including the case tables read while decoding.
+    def bytes_per_second(self):
+        seconds = self.phases.get('decode', [0, 0.0, 0.0, 0.0])[3]
+        return self.bytes() / seconds if seconds else None
+
+    # Start and stop recording the memory allocated, keeping the peak and
+    # the sites that allocated the most.
+    def trace_memory(self):
+        tracemalloc.start()
+
+    def stop_tracing_memory(self, top = 10):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.memory = { 'current': current,
+                        'peak':    peak,
+                        'top':     [{ 'site': str(s.traceback), 'size': s.size, 'count': s.count }
+                                    for s in snapshot.statistics('lineno')[:top]] }
+
+    def as_dict(self):
+        return { 'elapsed':          time.perf_counter() - self.start[0],
+                 'cpu':              time.process_time() - self.start[1],
+                 'phases':           { name: { 'calls': p[0], 'wall': p[1], 'cpu': p[2], 'total_wall': p[3] }
+                                       for name, p in sorted(self.phases.items()) },
+                 'instructions':     self.instructions(),
+                 'bytes':            self.bytes(),
+                 'bytes_per_second': self.bytes_per_second(),
+                 'cached_segments':  self.cached_segments,
+                 'segments':         { seg_name: { 'instructions': sum(c[0] for c in procs.values()),
+                                                   'bytes':        sum(c[1] for c in procs.values()),
+                                                   'procs':        { proc_name: { 'instructions': c[0], 'bytes': c[1] }
+                                                                     for proc_name, c in sorted(procs.items()) } }
+                                       for seg_name, procs in sorted(self.segments.items()) },
+                 'opcodes':          dict(self.opcodes.most_common()),
+                 'memory':           self.memory }
+
+    # Add the counts and phase times of d, the as_dict() of the Stats of
+    # a worker process.
+    def merge(self, d):
+        for name, p in d['phases'].items():
+            q = self.phases.setdefault(name, [0, 0.0, 0.0, 0.0])
+            q[0] += p['calls']
+            q[1] += p['wall']
+            q[2] += p['cpu']
+            q[3] += p['total_wall']
+        for seg_name, seg in d['segments'].items():
+            procs = self.segments.setdefault(seg_name, {})
+            for proc_name, c in seg['procs'].items():
+                counts = procs.setdefault(proc_name, [0, 0])
+                counts[0] += c['instructions']
+                counts[1] += c['bytes']
+        self.opcodes.update(d['opcodes'])
+
+    def write_json(self, file):
+        json.dump(self.as_dict(), file, indent = 2)
+        file.write('\n')
+
+    def summary(self, file, top = 10):
+        d = self.as_dict()
+        print('%-12s %8s %10s %10s %10s' % ('phase', 'calls', 'wall', 'cpu', 'total'), file = file)
+        for name, p in d['phases'].items():
+            print('%-12s %8d %10.4f %10.4f %10.4f' % (name, p['calls'], p['wall'], p['cpu'], p['total_wall']), file = file)
+        print('%-12s %8s %10.4f %10.4f' % ('elapsed', '', d['elapsed'], d['cpu']), file = file)
+        procs = sum(len(procs) for procs in self.segments.values())
+        rate = d['bytes_per_second']
+        print('%d segments, %d procedures, %d instructions, %d bytes decoded%s' %
+              (len(self.segments), procs, d['instructions'], d['bytes'],
+               ', %.0f bytes/s' % rate if rate is not None else ''), file = file)
+        if self.cached_segments:
+            print('%d segments from the cache' % self.cached_segments, file = file)
+        if d['instructions']:
+            print('opcodes: ' + ', '.join('%s %.1f%%' % (mnem, 100.0 * count / d['instructions'])
+                                          for mnem, count in self.opcodes.most_common(top)), file = file)
+        if self.memory is not None:
+            print('memory: peak %d bytes' % self.memory['peak'], file = file)
+
+null_phase = contextlib.nullcontext()
+
+# A context in which the time is charged to phase name of stats, if it
+# isn't None.
+def stats_phase(stats, name):
+    if stats is None:
+        return null_phase
+    return stats.phase(name)
+
+
+# Disassemble one code segment from data, a buffer holding its blocks.  If
+# procs is not None, only the procedures with those numbers are loaded
+# and disassembled.
+def dis_code_segment(dis, seg_num, seg_length, seg_name, data, out, procs = None):
+    dis.mem_init()
+    if procs is None:
+        dis.load_words(data)
+    else:
+        procs = dis.load_procs(data, seg_length, procs)
+        if not procs:
+            print('segment %s has no such procedure' % seg_name, file = dis.log)
+            return
+    dis.procs = procs
+    with dis.phase('pass_1'):
+        dis.dis_seg(seg_num, 0, seg_length, seg_name, None)
+    dis.pass_2(out)
+
+# Runs in a worker process, or directly when caching, returning the
+# diagnostic messages, the output of a renderer of class renderer_class,
+# the call sites of the segment, and if stats is true, the as_dict() of
+# the Stats of the disassembly, otherwise None.
+def dis_code_segment_job(renderer_class, options, seg_num, seg_length, seg_name, data, procs,
+                         stats = False):
+    log = io.StringIO()
+    df = io.StringIO()
+    stats = Stats() if stats else None
+    dis = Disassembler(log = log, stats = stats, **options)
+    out = renderer_class(df, header = False)
+    if stats is not None:
+        stats.instrument_renderer(out)
+    dis_code_segment(dis, seg_num, seg_length, seg_name, data, out, procs)
+    return log.getvalue(), df.getvalue(), dis.calls, stats.as_dict() if stats is not None else None
 
 # III.0 uses a code file header similar to II.0
-def dis_ucsd_codefile(cf, header, df):
+# If segments is not None, only the code segments it lists, by name or
+# number, are disassembled, and if procs is not None, only the procedures
+# it lists, by number.  If cache is not None, it is a SegmentCache used
+# to avoid disassembling segments that have been seen before.  If
+# callgraph is not None, the calls found are added to it.
+def dis_ucsd_codefile(codefile, out, log = None, jobs = 1, options = None, segments = None, procs = None,
+                      cache = None, callgraph = None, stats = None):
     verbose = False
-    # traditional p-System code file header
-    seg_info = [get_code_seg_info(header, i) for i in range(16)]
-
-    # XXX Support for vectored code files (which can have segments 0..15 for
-    # system, or 128..143 for user, has not been tested.
-    code_kind = ['static', 'vectored'][header[0x16f]]
-    if code_kind == 'vectored':
-        last_seg = get16(header, 0x170)
-        last_code_block = get16(header, 0x172)
-        orig_f_pos = cf.tell()
-        cf.seek((last_code_block + 1) * 512)
-        for i in range(16, lastseg, 16):
-            seg_page = cf.read(512)
-            seg_info.append([get_code_seg_info(header, i) for i in range(16)])
-        cf.seek(orig_f_pos)
-
-    block_info = {}
-
-    for i in range(len(seg_info)):
-        si = seg_info[i]
-        if si.block != 0:
-            if si.kind < 5:
-                kind = ['linked', 'hostseg', 'segproc', 'unitseg', 'seprtseg'][si.kind]
-            else:
-                kind = str(si.kind)
-            assert si.block not in block_info
-            block_info[si.block] = BlockInfo(block = si.block,
-                                             block_count = (si.length + 255) // 256,
-
-                                             kind = kind,
-                                             what = 'code',
-                                             seg_info = si)
-            if kind == 'unitseg':
-                assert si.addr != 0
-                assert si.addr not in block_info
-                block_info[si.addr] = BlockInfo(block = si.addr,
-                                                block_count = si.block - si.addr,
-                                                kind = kind,
-                                                what = 'interface',
-                                                seg_info = si)
+    block_info = codefile.block_info
+    if options is None:
+        options = {}
+    if callgraph is not None:
+        seg_names = callgraph.seg_names(codefile)
+
+    selected = None
+    if segments is not None:
+        selected = set(codefile.find_segment(spec).block for spec in segments)
 
     print_seg_list = True
     if print_seg_list:
-        print('       blk  leng name     kind     addr cver')
+        print('       blk  leng name     kind     addr cver', file = log)
     sk = sorted(block_info.keys())
     for i in range(len(sk)):
         block = sk[i]
@@ -774,20 +2426,25 @@ def dis_ucsd_codefile(cf, header, df):
         si = bi.seg_info
         if bi.what == 'interface':
             if print_seg_list:
-                print('interface')
+                out.flush()
+                print('interface', file = log)
         elif bi.what == 'code':
             if print_seg_list:
-                print('seg%02d: %04x %04x %s %-8s %04x %04x' % (si.segnum,
-                                                                si.block,
-                                                                si.length,
-                                                                si.name,
-                                                                bi.kind,
-                                                                si.addr,
-                                                                si.codeversion),
-                      file = df)
+                out.record(SegmentEntry(seg_num = si.segnum,
+                                        block = si.block,
+                                        length = si.length,
+                                        name = si.name,
+                                        kind = bi.kind,
+                                        addr = si.addr,
+                                        codeversion = si.codeversion))
     if verbose:
-        print(file = df)
+        out.blank()
 
+    # Each step is a diagnostic message, and optionally a segment to be
+    # disassembled after the message is printed.  Segments are read
+    # directly from their blocks, so those that aren't selected cost
+    # nothing.
+    steps = []
     expected_block = 1
     for i in range(len(sk)):
         block = sk[i]
@@ -796,37 +2453,1137 @@ def dis_ucsd_codefile(cf, header, df):
         assert block >= expected_block
         if block > expected_block:
             count = block - expected_block
-            print("skipping %d blocks of unknown content" % count)
-            cf.read(512 * count)
+            if selected is None:
+                steps.append(("skipping %d blocks of unknown content" % count, None))
             expected_block += count
             assert block == expected_block
         if bi.what == 'interface':
-            print('%d blocks of interface text' % bi.block_count)
-            cf.read(512 * bi.block_count)
+            if selected is None:
+                steps.append(('%d blocks of interface text' % bi.block_count, None))
+        elif bi.what == 'index':
+            if selected is None:
+                steps.append(('AOS index block', None))
         elif bi.what == 'code':
-            seg_name = si.name.strip()
-            if seg_name == '':
-                seg_name = 'seg%d' % si.segnum
-            mem_init()
-            print("reading segment %s, file pos %04x" % (seg_name, cf.tell()))
-            read_words(cf, bi.block_count * 256)
-            dis_seg(si.segnum, 0, si.length, seg_name, None)
-            pass_2(df)
+            if selected is None or block in selected:
+                seg_name = seg_info_name(si)
+                message = "reading segment %s, file pos %04x" % (seg_name, block * 512)
+                steps.append((message, si))
         else:
             assert False
 
         expected_block += bi.block_count
 
-
-def dis_codefile(cf, df):
-    header = cf.read(512)
-    if get16(header, 0) == 0xffff:
-        dis_aos_codefile(cf, header, df)
+    # With a cache, each segment's results are looked up by key, and
+    # only the misses are disassembled.
+    keys = [None] * len(steps)
+    cached = [None] * len(steps)
+    if cache is not None:
+        key_options = (out.__class__.__name__, sorted(options.items()), procs)
+        for i, (message, si) in enumerate(steps):
+            if si is not None:
+                with codefile.segment_data(si) as data:
+                    keys[i] = cache.key(si.segnum, si.length, seg_info_name(si), data, key_options)
+                cached[i] = cache.get(keys[i])
+
+    out.flush()
+    if jobs == 1 and cache is None:
+        dis = Disassembler(log = log, stats = stats, **options)
+        for message, si in steps:
+            print(message, file = log)
+            if si is not None:
+                with codefile.segment_data(si) as data:
+                    dis_code_segment(dis, si.segnum, si.length, seg_info_name(si), data,
+                                     out, procs)
+                if callgraph is not None:
+                    callgraph.add_calls(seg_info_name(si), dis.calls, seg_names)
+        return
+
+    # Segments are independent of each other, so they can be disassembled
+    # by worker processes.  The results are written out in block order, so
+    # the output is the same as from the sequential path.
+    executor = None
+    if jobs != 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs)
+    try:
+        futures = [None] * len(steps)
+        if executor is not None:
+            for i, (message, si) in enumerate(steps):
+                if si is not None and cached[i] is None:
+                    with codefile.segment_data(si) as data:
+                        futures[i] = executor.submit(dis_code_segment_job, type(out), options,
+                                                     si.segnum, si.length, seg_info_name(si),
+                                                     bytes(data), procs, stats is not None)
+        for i, (message, si) in enumerate(steps):
+            print(message, file = log)
+            if si is None:
+                continue
+            if cached[i] is not None:
+                seg_log, seg_listing, calls = cached[i]
+                if stats is not None:
+                    stats.cached_segments += 1
+            else:
+                if futures[i] is not None:
+                    seg_log, seg_listing, calls, seg_stats = futures[i].result()
+                else:
+                    with codefile.segment_data(si) as data:
+                        seg_log, seg_listing, calls, seg_stats = dis_code_segment_job(type(out), options,
+                                                                                      si.segnum, si.length,
+                                                                                      seg_info_name(si),
+                                                                                      data, procs,
+                                                                                      stats is not None)
+                if cache is not None:
+                    cache.put(keys[i], seg_log, seg_listing, calls)
+                if stats is not None:
+                    stats.merge(seg_stats)
+            print(seg_log, end = '', file = log)
+            with stats_phase(stats, 'output'):
+                out.file.write(seg_listing)
+            if callgraph is not None:
+                callgraph.add_calls(seg_info_name(si), calls, seg_names)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def dis_codefile(cf, df, log = None, jobs = 1, format = 'text', options = None,
+                 segments = None, procs = None, cache = None, callgraph = None, stats = None,
+                 aos_layout = False):
+    out = renderers[format](df)
+    if stats is not None:
+        stats.instrument_renderer(out)
+    with stats_phase(stats, 'read'):
+        codefile = CodeFile.open(cf, aos_layout)
+    if codefile.aos:
+        dis_aos_codefile(codefile, out, log, jobs, options, segments, procs, cache, callgraph, stats)
+    else:
+        dis_ucsd_codefile(codefile, out, log, jobs, options, segments, procs, cache, callgraph, stats)
+    out.flush()
+
+
+# Disassemble the code files in volume whose names match any of the glob
+# patterns, in block order, into one listing.  Each file is read once,
+# directly from the volume image.  If segments is not None, files that
+# contain none of the listed segments are skipped.
+def dis_volume(volume, patterns, df, log = None, jobs = 1, format = 'text', options = None,
+               segments = None, procs = None, cache = None, callgraph = None, stats = None,
+               aos_layout = False):
+    out = renderers[format](df)
+    if stats is not None:
+        stats.instrument_renderer(out)
+    for entry in volume.find(patterns):
+        if entry.kind != file_kinds.index('code'):
+            print('skipping %s, not a code file' % entry.name, file = log)
+            continue
+        with stats_phase(stats, 'read'):
+            codefile = CodeFile(volume.file_data(entry), aos_layout)
+        file_segments = segments
+        if segments is not None:
+            file_segments = []
+            for spec in segments:
+                try:
+                    codefile.find_segment(spec)
+                    file_segments.append(spec)
+                except KeyError:
+                    pass
+            if not file_segments:
+                continue
+        message = 'file %s, blocks %d-%d' % (entry.name, entry.first_block, entry.last_block - 1)
+        out.flush()
+        print(message, file = log)
+        out.record(Message(message))
+        out.blank()
+        if codefile.aos:
+            dis_aos_codefile(codefile, out, log, jobs, options, file_segments, procs, cache, callgraph, stats)
+        else:
+            dis_ucsd_codefile(codefile, out, log, jobs, options, file_segments, procs, cache, callgraph, stats)
+        out.blank()
+    out.flush()
+
+
+# Add the command line options shared by single file and batch mode to
+# parser.
+def add_disassembler_options(parser):
+    parser.add_argument('--format', choices = sorted(renderers.keys()), default = 'text', help = 'output format (default: %(default)s)')
+    parser.add_argument('--fill', action = 'store_true', help = 'list runs of identical data words as one line')
+    parser.add_argument('--fill-min', type = int, default = 4, help = 'shortest run listed as one line with --fill (default: %(default)s)')
+    parser.add_argument('--descent', action = 'store_true', help = 'decode only the code reachable from each procedure entry point')
+    parser.add_argument('--cfg', action = 'store_true', help = 'output the control flow graph of each procedure (implied by --format dot)')
+    parser.add_argument('--xref', action = 'store_true', help = 'annotate the listing with the references to each label and variable')
+    parser.add_argument('--signatures', metavar = 'DB', help = 'name the procedures found in a signature database built by pdis.py sigdb')
+    parser.add_argument('--skip-known', action = 'store_true', help = "with --signatures, don't list the instructions of the procedures found")
+    parser.add_argument('--cache', metavar = 'DIR', help = 'directory of cached segment results, which may be shared between runs')
+    parser.add_argument('--cache-size', type = int, default = 256, metavar = 'MB', help = 'size limit of the cache (default: %(default)s MB)')
+
+# The keyword arguments for a Disassembler, from the command line options
+# shared by single file and batch mode.  Raises OSError or ValueError if
+# the signature database can't be used.
+def disassembler_options(args):
+    if args.skip_known and args.signatures is None:
+        raise ValueError('--skip-known requires --signatures')
+    return { 'fill':       max(2, args.fill_min) if args.fill else None,
+             'descent':    args.descent,
+             'cfg':        args.cfg or args.format == 'dot',
+             'xref':       args.xref,
+             'signatures': SignatureDB(args.signatures) if args.signatures is not None else None,
+             'skip_known': args.skip_known }
+
+
+# Batch mode disassembles many code files, distributing them across a pool
+# of worker processes.  Each input gets its own listing, and an input whose
+# listing is newer than the input is skipped, so that an interrupted run
+# can be restarted without redoing the work already done.
+
+BatchJob = collections.namedtuple('BatchJob', ['input', 'output'])
+
+BatchResult = collections.namedtuple('BatchResult', ['input',
+                                                     'output',
+                                                     'status', # 'ok', 'skipped', 'failed'
+                                                     'seconds',
+                                                     'error'])
+
+def batch_find_inputs(specs, pattern):
+    inputs = []
+    for spec in specs:
+        if os.path.isdir(spec):
+            for dirpath, dirnames, filenames in os.walk(spec):
+                dirnames.sort()
+                for fn in sorted(filenames):
+                    if fnmatch.fnmatch(fn.lower(), pattern.lower()):
+                        path = os.path.join(dirpath, fn)
+                        inputs.append((path, os.path.relpath(path, spec)))
+        else:
+            paths = sorted(glob.glob(spec))
+            if not paths:
+                raise ValueError('no input files match ' + spec)
+            for path in paths:
+                inputs.append((path, os.path.basename(path)))
+    return inputs
+
+def batch_jobs(inputs, output_dir, suffix):
+    jobs = []
+    outputs = {}
+    for path, rel_path in inputs:
+        if output_dir is None:
+            output = path + suffix
+        else:
+            output = os.path.join(output_dir, rel_path + suffix)
+        if output in outputs:
+            raise ValueError('%s and %s would both be written to %s' % (outputs[output], path, output))
+        outputs[output] = path
+        jobs.append(BatchJob(input = path, output = output))
+    return jobs
+
+def batch_up_to_date(job):
+    try:
+        return os.path.getmtime(job.output) >= os.path.getmtime(job.input)
+    except OSError:
+        return False
+
+# Runs in a worker process.  The listing is written to a temporary file
+# that is renamed into place only once it is complete, so a partial
+# listing from an interrupted run is never mistaken for an up to date one.
+def batch_dis_file(job, format = 'text', options = None, cache = None):
+    start = time.perf_counter()
+    tmp = job.output + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(job.output) or '.', exist_ok = True)
+        with open(job.input, 'rb') as cf, open(tmp, 'w') as df:
+            dis_codefile(cf, df, log = io.StringIO(), format = format, options = options, cache = cache)
+        os.replace(tmp, job.output)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return BatchResult(input = job.input,
+                           output = job.output,
+                           status = 'failed',
+                           seconds = time.perf_counter() - start,
+                           error = traceback.format_exc())
+    return BatchResult(input = job.input,
+                       output = job.output,
+                       status = 'ok',
+                       seconds = time.perf_counter() - start,
+                       error = None)
+
+def batch_run(jobs, num_jobs = 1, force = False, progress = None, format = 'text', options = None,
+              cache = None):
+    results = []
+    todo = []
+    for job in jobs:
+        if not force and batch_up_to_date(job):
+            results.append(BatchResult(input = job.input,
+                                       output = job.output,
+                                       status = 'skipped',
+                                       seconds = 0.0,
+                                       error = None))
+        else:
+            todo.append(job)
+    if num_jobs == 1:
+        done = (batch_dis_file(job, format, options, cache) for job in todo)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = num_jobs)
+        futures = [executor.submit(batch_dis_file, job, format, options, cache) for job in todo]
+        done = (f.result() for f in concurrent.futures.as_completed(futures))
+    try:
+        for result in done:
+            if progress is not None:
+                print('%-7s %8.3f  %s' % (result.status, result.seconds, result.input),
+                      file = progress, flush = True)
+            results.append(result)
+    finally:
+        if num_jobs != 1:
+            executor.shutdown(cancel_futures = True)
+    order = { job.input: i for i, job in enumerate(jobs) }
+    results.sort(key = lambda r: order[r.input])
+    return results
+
+def batch_report(results, elapsed, file):
+    counts = collections.Counter(r.status for r in results)
+    print('%d files: %d disassembled, %d skipped as up to date, %d failed, %.3f seconds' %
+          (len(results), counts['ok'], counts['skipped'], counts['failed'], elapsed),
+          file = file)
+    for r in results:
+        if r.status == 'failed':
+            print('failed: %s' % r.input, file = file)
+            print(r.error, file = file)
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog = 'pdis.py batch',
+                                     description = 'disassemble many code files in parallel')
+    parser.add_argument('-j', '--jobs', type = int, default = os.cpu_count(), help = 'number of worker processes (default: number of CPUs)')
+    parser.add_argument('-o', '--output-dir', help = 'directory for listings (default: alongside each input)')
+    add_disassembler_options(parser)
+    parser.add_argument('--suffix', default = '.dis', help = 'suffix appended to input file names to name listings (default: %(default)s)')
+    parser.add_argument('--pattern', default = '*.code', help = 'file name pattern to match in input directories, ignoring case (default: %(default)s)')
+    parser.add_argument('--force', action = 'store_true', help = 'disassemble inputs even if their listings are up to date')
+    parser.add_argument('--report', type = argparse.FileType('w'), help = 'write a JSON report with per-file timing and failures')
+    parser.add_argument('inputs', nargs = '+', help = 'code files, directories, or glob patterns')
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = batch_jobs(batch_find_inputs(args.inputs, args.pattern),
+                          args.output_dir, args.suffix)
+        options = disassembler_options(args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    cache = None
+    if args.cache is not None:
+        cache = SegmentCache(args.cache, args.cache_size * 1024 * 1024)
+
+    start = time.perf_counter()
+    results = batch_run(jobs, max(1, args.jobs), args.force, progress = sys.stdout, format = args.format,
+                        options = options, cache = cache)
+    elapsed = time.perf_counter() - start
+
+    batch_report(results, elapsed, sys.stdout)
+    if args.report is not None:
+        json.dump({ 'elapsed': elapsed,
+                    'files': [r._asdict() for r in results] },
+                  args.report, indent = 2)
+        args.report.close()
+    return 1 if any(r.status == 'failed' for r in results) else 0
+
+
+# A procedure decoded by decode_code_file, with the DecodedInst list of
+# its instructions, the number of call instructions in it, and the
+# Disassembler that decoded it, whose memory and labels are those of the
+# procedure's segment until the next segment is decoded.
+DecodedProc = collections.namedtuple('DecodedProc', ['seg_name',
+                                                     'seg_num',
+                                                     'proc_num',
+                                                     'proc_offset',
+                                                     'end_offset',
+                                                     'local_size',
+                                                     'insts',
+                                                     'calls',
+                                                     'dis'])
+
+# Decode every procedure of codefile, without producing a listing,
+# yielding a DecodedProc for each, in procedure number order within each
+# segment.  If selected is not None, it is a dict of the procedure
+# numbers to decode by segment name, and only those are loaded and
+# decoded.
+def decode_code_file(codefile, selected = None):
+    dis = Disassembler(log = io.StringIO())
+    for si in codefile.code_segments():
+        seg_name = seg_info_name(si)
+        if selected is not None and seg_name not in selected:
+            continue
+        dis.mem_init()
+        with codefile.segment_data(si) as data:
+            if selected is None:
+                dis.load_words(data)
+                dis.procs = None
+            else:
+                dis.procs = dis.load_procs(data, si.length, selected[seg_name])
+        dis.dis_seg(si.segnum, 0, si.length, seg_name, None)
+        calls = collections.Counter(site.proc for site in dis.calls)
+        mem = dis.mem
+        proc_dir = mem[0]
+        for p in range(1, (mem[proc_dir] >> 8) + 1):
+            po = mem[proc_dir - p]
+            end_offset = mem[po - 1]
+            insts = dis.decoded_procs.get((0, po, end_offset))
+            if insts is not None:
+                yield DecodedProc(seg_name, si.segnum, p, po, end_offset, mem[po], insts, calls['proc%d' % p], dis)
+
+
+# Analytics mode and search mode both build up a store from many code
+# files: a corpus or an index, saved to a file that later runs add to.
+# Files are identified by the SHA-256 of their contents, so only files
+# that aren't in the store yet are processed, each by a worker function
+# run in a pool of processes, given its path and SHA-256.  Its result
+# is a namedtuple with input, sha256, status ('ok' or 'failed') and
+# error fields, which the store's add method takes.
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(map_file(f)).hexdigest()
+
+# Returns the results of the files not yet in store, in input order.
+# Results are added to the store in input order too, each as soon as
+# those of the files before it have been, so that the file indices in
+# the store don't depend on the order in which workers finish.
+def corpus_run(store, inputs, worker, num_jobs = 1, progress = None):
+    todo = []
+    todo_sha256s = set()
+    for path in inputs:
+        sha256 = file_sha256(path)
+        if sha256 in store or sha256 in todo_sha256s:
+            continue
+        todo.append((path, sha256))
+        todo_sha256s.add(sha256)
+    results = [None] * len(todo)
+    if num_jobs == 1:
+        done = ((i, worker(path, sha256)) for i, (path, sha256) in enumerate(todo))
     else:
-        dis_ucsd_codefile(cf, header, df)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = num_jobs)
+        futures = { executor.submit(worker, path, sha256): i for i, (path, sha256) in enumerate(todo) }
+        done = ((futures[f], f.result()) for f in concurrent.futures.as_completed(futures))
+    added = 0
+    try:
+        for i, result in done:
+            if progress is not None:
+                print('%-7s %s' % (result.status, result.input), file = progress, flush = True)
+            results[i] = result
+            while added < len(results) and results[added] is not None:
+                if results[added].status == 'ok':
+                    store.add(results[added])
+                added += 1
+    finally:
+        if num_jobs != 1:
+            executor.shutdown(cancel_futures = True)
+    return results
+
+# The command line of analytics and search index modes.  what is the
+# name of the store, as in 'corpus', and store_class the class of it,
+# with load and save methods and a summary of its contents.
+def corpus_main(argv, prog, description, metavar, what, store_class, worker):
+    parser = argparse.ArgumentParser(prog = prog, description = description)
+    parser.add_argument('-j', '--jobs', type = int, default = os.cpu_count(), help = 'number of worker processes (default: number of CPUs)')
+    parser.add_argument('-o', '--output', required = True, metavar = metavar, help = '%s file; if it exists, files not already in it are added' % what)
+    parser.add_argument('--pattern', default = '*.code', help = 'file name pattern to match in input directories, ignoring case (default: %(default)s)')
+    parser.add_argument('inputs', nargs = '+', help = 'code files, directories, or glob patterns')
+    args = parser.parse_args(argv)
+
+    try:
+        inputs = [path for path, rel_path in batch_find_inputs(args.inputs, args.pattern)]
+        if os.path.exists(args.output):
+            store = store_class.load(args.output)
+        else:
+            store = store_class()
+    except (ImportError, OSError, ValueError) as e:
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    results = corpus_run(store, inputs, worker, max(1, args.jobs), progress = sys.stdout)
+    store.save(args.output)
+    elapsed = time.perf_counter() - start
+
+    failed = [r for r in results if r.status == 'failed']
+    print('%d files: %d added, %d already in the %s, %d failed, %.3f seconds' %
+          (len(inputs), len(results) - len(failed), len(inputs) - len(results), what, len(failed), elapsed))
+    print('%s: %s' % (what, store.summary()))
+    for r in failed:
+        print('failed: %s' % r.input)
+        print(r.error)
+    return 1 if failed else 0
+
+
+# Analytics mode decodes many code files in parallel and aggregates their
+# instruction mix into a corpus saved as a NumPy .npz file: a histogram of
+# opcodes, counts of opcode bigrams and trigrams within each procedure, and
+# a table of procedures with their sizes and call counts.  When the
+# corpus already exists, only files that aren't in it yet are decoded and
+# added.  NumPy is only needed by analytics mode, so it's only imported there.
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('analytics mode requires numpy')
+    return numpy
+
+AnalyzeResult = collections.namedtuple('AnalyzeResult', ['input',
+                                                         'sha256',
+                                                         'status', # 'ok', 'failed'
+                                                         'error',
+                                                         'opcodes',  # counts by opcode byte
+                                                         'bigrams',  # { op1 << 8 | op2: count }
+                                                         'trigrams', # { op1 << 16 | op2 << 8 | op3: count }
+                                                         'procs'])   # rows of proc_columns
+
+# The columns of the procedure table, and their types.
+proc_columns = [('proc_file',       'int32'),  # index into files
+                ('proc_seg_name',   'str'),
+                ('proc_seg',        'int16'),
+                ('proc_num',        'int16'),
+                ('proc_local_size', 'int32'),
+                ('proc_bytes',      'int32'),  # code bytes, from the entry point to the end offset
+                ('proc_insts',      'int32'),
+                ('proc_calls',      'int32')]
+
+# Runs in a worker process.  Decodes every procedure of the code file at
+# path, without producing a listing.  NumPy isn't needed here.
+def analyze_file(path, sha256):
+    opcodes = [0] * 256
+    bigrams = collections.Counter()
+    trigrams = collections.Counter()
+    procs = []
+    try:
+        with open(path, 'rb') as f:
+            codefile = CodeFile(map_file(f))
+        for proc in decode_code_file(codefile):
+            ops = [inst.entry.opcode for inst in proc.insts]
+            for op in ops:
+                opcodes[op] += 1
+            bigrams.update((a << 8) | b for a, b in zip(ops, ops[1:]))
+            trigrams.update((a << 16) | (b << 8) | c for a, b, c in zip(ops, ops[1:], ops[2:]))
+            procs.append((proc.seg_name, proc.seg_num, proc.proc_num, proc.local_size,
+                          proc.end_offset + 1 - (proc.proc_offset + 1) * 2, len(proc.insts), proc.calls))
+    except Exception:
+        return AnalyzeResult(path, sha256, 'failed', traceback.format_exc(), None, None, None, None)
+    return AnalyzeResult(path, sha256, 'ok', None, opcodes, dict(bigrams), dict(trigrams), procs)
+
+class Corpus:
+    def __init__(self):
+        self.np = import_numpy()
+        self.files = []
+        self.file_sha256 = []
+        self.sha256s = set()  # those of file_sha256, for lookups
+        self.opcodes = self.np.zeros(256, self.np.int64)
+        self.bigrams = self.np.zeros((256, 256), self.np.int64)
+        self.trigrams = collections.Counter()
+        self.procs = { name: [] for name, dtype in proc_columns }
+
+    @classmethod
+    def load(cls, path):
+        corpus = cls()
+        with corpus.np.load(path) as d:
+            corpus.files = d['files'].tolist()
+            corpus.file_sha256 = d['file_sha256'].tolist()
+            corpus.sha256s = set(corpus.file_sha256)
+            corpus.opcodes += d['opcodes']
+            corpus.bigrams += d['bigrams']
+            corpus.trigrams.update(dict(zip(d['trigram_keys'].tolist(), d['trigram_counts'].tolist())))
+            for name, dtype in proc_columns:
+                corpus.procs[name] = d[name].tolist()
+        return corpus
+
+    def __contains__(self, sha256):
+        return sha256 in self.sha256s
+
+    def add(self, result):
+        np = self.np
+        file_index = len(self.files)
+        self.files.append(result.input)
+        self.file_sha256.append(result.sha256)
+        self.sha256s.add(result.sha256)
+        self.opcodes += np.array(result.opcodes, np.int64)
+        if result.bigrams:
+            np.add.at(self.bigrams.reshape(-1),
+                      np.fromiter(result.bigrams.keys(), np.int64, len(result.bigrams)),
+                      np.fromiter(result.bigrams.values(), np.int64, len(result.bigrams)))
+        self.trigrams.update(result.trigrams)
+        for row in result.procs:
+            self.procs['proc_file'].append(file_index)
+            for (name, dtype), value in zip(proc_columns[1:], row):
+                self.procs[name].append(value)
+
+    def arrays(self):
+        np = self.np
+        trigram_keys = sorted(self.trigrams)
+        arrays = { 'files':          np.array(self.files, dtype = str),
+                   'file_sha256':    np.array(self.file_sha256, dtype = str),
+                   'opcode_names':   np.array([entry.mnem for entry in decode_table], dtype = str),
+                   'opcodes':        self.opcodes,
+                   'bigrams':        self.bigrams,
+                   'trigram_keys':   np.array(trigram_keys, np.uint32),
+                   'trigram_counts': np.array([self.trigrams[k] for k in trigram_keys], np.int64) }
+        for name, dtype in proc_columns:
+            arrays[name] = np.array(self.procs[name], dtype = dtype)
+        return arrays
+
+    def summary(self):
+        return '%d files, %d procedures, %d instructions' % (len(self.files), len(self.procs['proc_num']),
+                                                            int(self.opcodes.sum()))
+
+    # The file is replaced atomically, so an interrupted run leaves the
+    # previous corpus intact.
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            self.np.savez_compressed(f, **self.arrays())
+        os.replace(tmp, path)
+
+
+def analyze_main(argv):
+    return corpus_main(argv, 'pdis.py analyze',
+                       'aggregate opcode, n-gram and procedure statistics of many code files into a NumPy .npz corpus',
+                       'NPZ', 'corpus', Corpus, analyze_file)
+
+
+# Search mode finds sequences of instructions across many code files,
+# through an inverted index built from their decoded instructions.  Each
+# procedure's instructions are kept as (byte offset, mnemonic, operand
+# values), and the index maps each mnemonic, each pair of consecutive
+# mnemonics, and each (mnemonic, operand position, value) to the
+# positions where they occur, packed as procedure number << 32 | index
+# of the instruction in the procedure, that of the first instruction for
+# a pair.  A query is answered by taking the positions of its most
+# selective term, and checking the whole sequence only at those.
+#
+# A query is a sequence of instructions separated by ';'.  Each is a
+# mnemonic, which may be a glob pattern such as 'ld*', or '*' for any
+# instruction, followed by operand values, each a number or '*' for any
+# value.  A number may be prefixed by a word, as in the listing, so
+# 'cxg seg5 proc3' matches the same as 'cxg 5 3', and words on their own,
+# as in 'cxg seg 5 proc 3', are ignored.  Operands not given match any
+# value.
+
+QueryInst = collections.namedtuple('QueryInst', ['mnem',       # glob pattern, or None for any
+                                                 'operands'])  # values, None for any
+
+SearchHit = collections.namedtuple('SearchHit', ['file', 'seg_name', 'proc_name', 'byte_offset', 'insts'])
+
+def parse_query(query):
+    pattern = []
+    for part in query.split(';'):
+        tokens = part.split()
+        if not tokens:
+            raise ValueError('empty instruction in query: %s' % query)
+        mnem = None if tokens[0] == '*' else tokens[0].lower()
+        operands = []
+        for token in tokens[1:]:
+            if token == '*':
+                operands.append(None)
+                continue
+            digits = token.lstrip('abcdefghijklmnopqrstuvwxyz_ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+            if not digits:
+                continue
+            try:
+                operands.append(int(digits, 0))
+            except ValueError:
+                raise ValueError('bad operand %s in query: %s' % (token, query))
+        pattern.append(QueryInst(mnem, tuple(operands)))
+    return pattern
+
+def search_key_mnem(mnem):
+    return mnem
+
+def search_key_pair(mnem1, mnem2):
+    return mnem1 + ';' + mnem2
+
+def search_key_operand(mnem, i, value):
+    return '%s %d %d' % (mnem, i, value)
+
+IndexResult = collections.namedtuple('IndexResult', ['input',
+                                                     'sha256',
+                                                     'status', # 'ok', 'failed'
+                                                     'error',
+                                                     'procs']) # (segment name, procedure name, instructions)
+
+# Runs in a worker process, returning the instructions of each
+# procedure of the code file at path.
+def index_file(path, sha256):
+    procs = []
+    try:
+        with open(path, 'rb') as f:
+            codefile = CodeFile(map_file(f))
+        for proc in decode_code_file(codefile):
+            procs.append((proc.seg_name, 'proc%d' % proc.proc_num,
+                          [(inst.byte_offset, inst.entry.mnem, tuple(inst.operands or inst.entry.imm_operands))
+                           for inst in proc.insts]))
+    except Exception:
+        return IndexResult(path, sha256, 'failed', traceback.format_exc(), None)
+    return IndexResult(path, sha256, 'ok', None, procs)
+
+class SearchIndex:
+    version = 2
+    # the number of bits of a position that hold the index of the
+    # instruction; a segment of 64K words can hold more than 64K
+    # instructions
+    inst_bits = 32
+    inst_mask = (1 << inst_bits) - 1
+
+    def __init__(self):
+        self.files = []      # paths
+        self.file_sha256 = []
+        self.sha256s = set() # those of file_sha256, for lookups
+        self.procs = []      # (file index, segment name, procedure name, instructions)
+        self.postings = {}   # key -> array of packed positions
+        self.mnems = None    # the mnemonics in postings, found when first needed
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'rb') as f:
+            d = pickle.load(f)
+        if d.get('version') != cls.version:
+            raise ValueError('%s: unsupported index version' % path)
+        index.files = d['files']
+        index.file_sha256 = d['file_sha256']
+        index.sha256s = set(index.file_sha256)
+        index.procs = d['procs']
+        index.postings = d['postings']
+        return index
+
+    def summary(self):
+        return '%d files, %d procedures, %d keys' % (len(self.files), len(self.procs), len(self.postings))
+
+    # The file is replaced atomically, so an interrupted run leaves the
+    # previous index intact.
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({ 'version':     self.version,
+                          'files':       self.files,
+                          'file_sha256': self.file_sha256,
+                          'procs':       self.procs,
+                          'postings':    self.postings },
+                        f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def __contains__(self, sha256):
+        return sha256 in self.sha256s
+
+    def add(self, result):
+        file_index = len(self.files)
+        self.files.append(result.input)
+        self.file_sha256.append(result.sha256)
+        self.sha256s.add(result.sha256)
+        self.mnems = None
+        postings = self.postings
+        for seg_name, proc_name, insts in result.procs:
+            base = len(self.procs) << self.inst_bits
+            self.procs.append((file_index, seg_name, proc_name, insts))
+            for i, (byte_offset, mnem, operands) in enumerate(insts):
+                pos = base | i
+                keys = [search_key_mnem(mnem)]
+                if i + 1 < len(insts):
+                    keys.append(search_key_pair(mnem, insts[i + 1][1]))
+                for j, value in enumerate(operands):
+                    keys.append(search_key_operand(mnem, j, value))
+                for key in keys:
+                    p = postings.get(key)
+                    if p is None:
+                        p = postings[key] = array.array('Q')
+                    p.append(pos)
+
+    def mnemonics(self, pattern):
+        if not any(c in pattern for c in '*?['):
+            return [pattern]
+        if self.mnems is None:
+            self.mnems = [key for key in self.postings if ';' not in key and ' ' not in key]
+        return [m for m in self.mnems if fnmatch.fnmatchcase(m, pattern)]
+
+    # Returns the positions at which the sequence may start, from its most
+    # selective term.
+    def candidates(self, pattern):
+        best = None
+        for i, q in enumerate(pattern):
+            if q.mnem is None:
+                continue
+            mnems = self.mnemonics(q.mnem)
+            terms = [[search_key_mnem(m) for m in mnems]]
+            for j, value in enumerate(q.operands):
+                if value is not None:
+                    terms.append([search_key_operand(m, j, value) for m in mnems])
+            if i + 1 < len(pattern) and pattern[i + 1].mnem is not None:
+                next_mnems = self.mnemonics(pattern[i + 1].mnem)
+                terms.append([search_key_pair(m, n) for m in mnems for n in next_mnems])
+            for keys in terms:
+                count = sum(len(self.postings.get(key, ())) for key in keys)
+                if best is None or count < best[0]:
+                    best = (count, i, keys)
+        if best is None:
+            raise ValueError('a query needs at least one instruction other than *')
+        count, i, keys = best
+        if i == 0:
+            return itertools.chain.from_iterable(self.postings.get(key, ()) for key in keys)
+        # a term that isn't the first may match near the start of a procedure
+        return (pos - i for key in keys for pos in self.postings.get(key, ()) if (pos & self.inst_mask) >= i)
+
+    def search(self, query, limit = None):
+        pattern = parse_query(query)
+        hits = []
+        for pos in sorted(set(self.candidates(pattern))):
+            file_index, seg_name, proc_name, insts = self.procs[pos >> self.inst_bits]
+            start = pos & self.inst_mask
+            seq = insts[start : start + len(pattern)]
+            if len(seq) < len(pattern):
+                continue
+            for q, (byte_offset, mnem, operands) in zip(pattern, seq):
+                if q.mnem is not None and not fnmatch.fnmatchcase(mnem, q.mnem):
+                    break
+                if len(q.operands) > len(operands):
+                    break
+                if any(v is not None and v != o for v, o in zip(q.operands, operands)):
+                    break
+            else:
+                hits.append(SearchHit(self.files[file_index], seg_name, proc_name, seq[0][0], seq))
+                if limit is not None and len(hits) >= limit:
+                    break
+        return hits
+
+def index_main(argv):
+    return corpus_main(argv, 'pdis.py index',
+                       'build an index of the instructions of many code files for pdis.py search',
+                       'INDEX', 'index', SearchIndex, index_file)
+
+def search_main(argv):
+    parser = argparse.ArgumentParser(prog = 'pdis.py search',
+                                     description = "find sequences of instructions, such as 'ldcn; equpwr' or 'cxg seg5 proc *', in the code files of an index built by pdis.py index")
+    parser.add_argument('--limit', type = int, help = 'stop after this many hits of each query')
+    parser.add_argument('index', help = 'index file')
+    parser.add_argument('queries', nargs = '+', metavar = 'query', help = "instructions separated by ';', each a mnemonic or glob pattern, or * for any instruction, followed by operand values or *")
+    args = parser.parse_args(argv)
+
+    try:
+        index = SearchIndex.load(args.index)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    for query in args.queries:
+        start = time.perf_counter()
+        try:
+            hits = index.search(query, args.limit)
+        except ValueError as e:
+            parser.error(str(e))
+        elapsed = time.perf_counter() - start
+        for hit in hits:
+            print('%s  %s.%s+%04x  %s' % (hit.file, hit.seg_name, hit.proc_name, hit.byte_offset,
+                                         '; '.join(' '.join([mnem] + [str(v) for v in operands])
+                                                   for byte_offset, mnem, operands in hit.insts)))
+        print('%s: %d hits, %.3f ms' % (query, len(hits), elapsed * 1000), file = sys.stderr)
+    return 0
+
+
+# A hash of the normalized instructions of a procedure, insts a list of
+# DecodedInst from the segment at seg_base of memory mem, that doesn't
+# depend on where the procedure is in its segment: jump operands are
+# already relative to the instruction, and the case table offset of an
+# xjp is replaced by the table's first index and its targets relative to
+# the instruction.  Labels aren't included.  Operands whose render kind,
+# such as 'segment', is in mask are left out, so procedures that differ
+# only in those have the same fingerprint.
+def proc_fingerprint(insts, local_size, mem, seg_base = 0, mask = frozenset()):
+    parts = [local_size]
+    for inst in insts:
+        entry = inst.entry
+        parts.append(entry.opcode)
+        for opnd, parm in zip(entry.operands, inst.operands):
+            if opnd.render == 'case':
+                next_offset = inst.byte_offset + inst.length
+                parts.append(('case', mem[seg_base + parm], tuple(t - next_offset for t, label in inst.labels)))
+            elif opnd.render in mask:
+                parts.append(None)
+            else:
+                parts.append(parm)
+    return hashlib.blake2b(repr(parts).encode(), digest_size = 16).digest()
+
+def proc_full_name(seg_name, proc_num):
+    return '%s.proc%d' % (seg_name, proc_num)
+
+
+# A signature database names known procedures, such as those of the
+# runtime and of units that are linked into many programs, by their
+# fingerprints.  Segment numbers depend on how a program was linked, so
+# they're masked out of the fingerprints.  The file is a hash table with
+# open addressing that is used in place through an mmap, so opening it
+# reads nothing, and a lookup reads one or a few slots:
+#   header: magic, slot count, entry count
+#   slots:  fingerprint (16 bytes), offset of the name plus one, or zero
+#           for an empty slot
+#   names:  each a length byte followed by the UTF-8 name
+# The table is rewritten whenever entries are added, with at least twice
+# as many slots as entries, so probe sequences stay short.
+
+signature_mask = frozenset(['segment'])
+
+class SignatureDB:
+    magic = b'PDISSIG1'
+    header = struct.Struct('<8sII')
+    slot = struct.Struct('<16sI')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.buf = map_file(f)
+        if len(self.buf) < self.header.size:
+            raise ValueError('%s: not a signature database' % path)
+        magic, self.slot_count, self.count = self.header.unpack_from(self.buf, 0)
+        if magic != self.magic or self.slot_count == 0:
+            raise ValueError('%s: not a signature database' % path)
+        self.names_offset = self.header.size + self.slot_count * self.slot.size
+        self.digest = None  # of the contents, found when first needed
+
+    # Worker processes reopen the file by name.
+    def __getstate__(self):
+        return { 'path': self.path }
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    # The contents are part of the key of cached segments, so they are
+    # only read when the repr is needed for a key.
+    def __repr__(self):
+        if self.digest is None:
+            self.digest = hashlib.sha256(self.buf).hexdigest()
+        return 'SignatureDB(%r, %s)' % (self.path, self.digest)
+
+    def name(self, offset):
+        offset += self.names_offset
+        length = self.buf[offset]
+        return bytes(self.buf[offset + 1 : offset + 1 + length]).decode('utf-8')
+
+    def lookup(self, fingerprint):
+        i = int.from_bytes(fingerprint[:8], 'little') % self.slot_count
+        while True:
+            fp, name = self.slot.unpack_from(self.buf, self.header.size + i * self.slot.size)
+            if name == 0:
+                return None
+            if fp == fingerprint:
+                return self.name(name - 1)
+            i = (i + 1) % self.slot_count
+
+    def entries(self):
+        for i in range(self.slot_count):
+            fp, name = self.slot.unpack_from(self.buf, self.header.size + i * self.slot.size)
+            if name != 0:
+                yield fp, self.name(name - 1)
+
+    # Write a database holding entries, a dict of name by fingerprint,
+    # to path.  The file is replaced atomically, so that it can be
+    # rewritten while open.
+    @classmethod
+    def write(cls, path, entries):
+        slot_count = max(16, 2 * len(entries) + 1)
+        slots = bytearray(slot_count * cls.slot.size)
+        names = bytearray()
+        for fp, name in entries.items():
+            i = int.from_bytes(fp[:8], 'little') % slot_count
+            while cls.slot.unpack_from(slots, i * cls.slot.size)[1] != 0:
+                i = (i + 1) % slot_count
+            cls.slot.pack_into(slots, i * cls.slot.size, fp, len(names) + 1)
+            # names are cut to 255 bytes, at a character boundary
+            encoded = name.encode('utf-8')[:255].decode('utf-8', errors = 'ignore').encode('utf-8')
+            names.append(len(encoded))
+            names += encoded
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(cls.header.pack(cls.magic, slot_count, len(entries)))
+            f.write(slots)
+            f.write(names)
+        os.replace(tmp, path)
+
+def sigdb_main(argv):
+    parser = argparse.ArgumentParser(prog = 'pdis.py sigdb',
+                                     description = 'add the procedures of code files, such as SYSTEM.LIBRARY, to a signature database used by --signatures to name them in other code files')
+    parser.add_argument('-o', '--output', required = True, metavar = 'DB', help = 'signature database; if it exists, the procedures are added to it')
+    parser.add_argument('--min-insts', type = int, default = 4, help = 'leave out procedures of fewer instructions than this, which are too common to identify (default: %(default)s)')
+    parser.add_argument('codefiles', nargs = '+', help = 'code files whose procedures are named after their segments, as in PASCALIO.proc7')
+    args = parser.parse_args(argv)
+
+    entries = {}
+    if os.path.exists(args.output):
+        try:
+            entries = dict(SignatureDB(args.output).entries())
+        except ValueError as e:
+            parser.error(str(e))
+    existing = len(entries)
+    small = 0
+    duplicates = 0
+    for path in args.codefiles:
+        try:
+            codefile = CodeFile.open(path)
+        except (OSError, ValueError) as e:
+            parser.error('%s: %s' % (path, e))
+        for proc in decode_code_file(codefile):
+            if len(proc.insts) < args.min_insts:
+                small += 1
+                continue
+            fp = proc_fingerprint(proc.insts, proc.local_size, proc.dis.mem, mask = signature_mask)
+            if fp in entries:
+                # the first name given to a procedure is kept
+                duplicates += 1
+                continue
+            entries[fp] = proc_full_name(proc.seg_name, proc.proc_num)
+    SignatureDB.write(args.output, entries)
+    print('%d procedures added, %d already known, %d too small; %d in the database' %
+          (len(entries) - existing, duplicates, small, len(entries)))
+    return 0
+
+
+# Diff mode compares two versions of a code file procedure by procedure.
+# Every procedure of both is fingerprinted straight from the bytes of its
+# segment, and only the procedures that differ are fully decoded, with
+# their labels and instruction text, to be listed.  Procedures with
+# the same name and fingerprint in both are unchanged.  Those with the
+# same fingerprint but a different segment or procedure number have moved,
+# and only those left with the same name but different fingerprints are
+# listed and diffed.  The listing of a procedure leaves out addresses and
+# offsets, so code that moves within the procedure doesn't make every
+# following line differ.
+
+ProcDiff = collections.namedtuple('ProcDiff', ['unchanged', # [name, ...]
+                                               'moved',     # [(old name, new name), ...]
+                                               'changed',   # [name, ...]
+                                               'removed',   # [name, ...]
+                                               'added'])    # [name, ...]
+
+# The fingerprints of the procedures of the segment seg_name, whose bytes
+# are data, by name.  They are those proc_fingerprint gives for the
+# procedures as decode_code_file decodes them, but only decode_inst is
+# used, so no labels or instruction text are made.  A case table's
+# entries are its targets relative to the xjp that follows it.  Words
+# past the end of data read as zero, as they do in the memory of a
+# Disassembler.
+def segment_fingerprints(seg_name, data):
+    def word(offset):
+        if 0 <= offset and offset * 2 + 2 <= len(data):
+            return data[offset * 2] + (data[offset * 2 + 1] << 8)
+        return 0
+    fingerprints = {}
+    proc_dir = word(0)
+    for p in range(1, (word(proc_dir) >> 8) + 1):
+        po = word(proc_dir - p)
+        end_offset = word(po - 1)
+        code = data
+        if end_offset + 4 > len(data):
+            code = bytes(data) + bytes(end_offset + 4 - len(data))
+        parts = [word(po)]
+        byte_offset = po * 2 + 2
+        while byte_offset <= end_offset:
+            entry, length, parms = decode_inst(code, byte_offset)
+            parts.append(entry.opcode)
+            for opnd, parm in zip(entry.operands, parms):
+                if opnd.render == 'case':
+                    first = word(parm)
+                    count = word(parm + 1) + 1 - first
+                    parts.append(('case', first, tuple(word(parm + 2 + i) for i in range(count))))
+                else:
+                    parts.append(parm)
+            byte_offset += length
+        fingerprints[proc_full_name(seg_name, p)] = hashlib.blake2b(repr(parts).encode(), digest_size = 16).digest()
+    return fingerprints
+
+def code_file_fingerprints(codefile):
+    fingerprints = {}
+    for si in codefile.code_segments():
+        with codefile.segment_data(si) as data:
+            fingerprints.update(segment_fingerprints(seg_info_name(si), data))
+    return fingerprints
+
+def diff_procs(old, new):
+    unchanged = sorted(name for name in old if new.get(name) == old[name])
+    old_left = { name: h for name, h in old.items() if new.get(name) != h }
+    new_left = { name: h for name, h in new.items() if old.get(name) != h }
+    by_hash = {}
+    for name in sorted(new_left):
+        by_hash.setdefault(new_left[name], []).append(name)
+    moved = []
+    for name in sorted(old_left):
+        names = by_hash.get(old_left[name])
+        if names:
+            moved.append((name, names.pop(0)))
+    for old_name, new_name in moved:
+        del old_left[old_name]
+        del new_left[new_name]
+    changed = sorted(name for name in old_left if name in new_left)
+    return ProcDiff(unchanged = unchanged,
+                    moved = moved,
+                    changed = changed,
+                    removed = sorted(name for name in old_left if name not in new_left),
+                    added = sorted(name for name in new_left if name not in old_left))
+
+# The listing lines of the procedures of codefile named in names, by name.
+def proc_listings(codefile, names):
+    selected = {}
+    for name in names:
+        seg_name, proc_name = name.rsplit('.', 1)
+        selected.setdefault(seg_name, []).append(int(proc_name[4:]))
+    listings = {}
+    for proc in decode_code_file(codefile, selected):
+        labels = proc.dis.labels
+        lines = ['localsize %d\n' % proc.local_size]
+        for inst in proc.insts:
+            label = labels.get(inst.byte_offset)
+            lines.append('%-19s %s\n' % ('' if label is None else label + ':',
+                                         inst.text.split('\t', 1)[0].rstrip()))
+        listings[proc_full_name(proc.seg_name, proc.proc_num)] = lines
+    return listings
+
+def diff_main(argv):
+    parser = argparse.ArgumentParser(prog = 'pdis.py diff',
+                                     description = 'compare two versions of a code file procedure by procedure')
+    parser.add_argument('-U', '--context', type = int, default = 3, help = 'lines of context in the diffs of changed procedures (default: %(default)s)')
+    parser.add_argument('--summary', action = 'store_true', help = "list the changed procedures without diffing them")
+    parser.add_argument('old', help = 'old code file')
+    parser.add_argument('new', help = 'new code file')
+    args = parser.parse_args(argv)
+
+    try:
+        old_file = CodeFile.open(args.old)
+        new_file = CodeFile.open(args.new)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    d = diff_procs(code_file_fingerprints(old_file), code_file_fingerprints(new_file))
+    print('%d procedures unchanged, %d moved, %d changed, %d removed, %d added' %
+          (len(d.unchanged), len(d.moved), len(d.changed), len(d.removed), len(d.added)))
+    for old_name, new_name in d.moved:
+        print('moved:   %s -> %s' % (old_name, new_name))
+    for name in d.removed:
+        print('removed: %s' % name)
+    for name in d.added:
+        print('added:   %s' % name)
+    for name in d.changed:
+        print('changed: %s' % name)
+    if d.changed and not args.summary:
+        old_listings = proc_listings(old_file, d.changed)
+        new_listings = proc_listings(new_file, d.changed)
+        for name in d.changed:
+            sys.stdout.writelines(difflib.unified_diff(old_listings[name], new_listings[name],
+                                                       '%s:%s' % (args.old, name),
+                                                       '%s:%s' % (args.new, name),
+                                                       n = args.context))
+    return 1 if d.moved or d.changed or d.removed or d.added else 0
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(batch_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'analyze':
+        sys.exit(analyze_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'index':
+        sys.exit(index_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'search':
+        sys.exit(search_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'diff':
+        sys.exit(diff_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'sigdb':
+        sys.exit(sigdb_main(sys.argv[2:]))
+
     parser = argparse.ArgumentParser()
 
     input_file_type_group = parser.add_mutually_exclusive_group()
@@ -835,46 +3592,164 @@ if __name__ == '__main__':
     input_file_type_group.add_argument('--rom',  action='store_true', help='disassemble boot ROM')
 
 #    parser.add_argument('--imd', nargs='?', type=argparse.FileType('rb'), help='get object file input from an ImageDisk image')
-    parser.add_argument('--imd', nargs='?', help='get object file input from an ImageDisk image')
+    parser.add_argument('--imd', metavar = 'IMAGE', help = 'get object file input from an ImageDisk image')
+
+    parser.add_argument('--volume', metavar = 'IMAGE', help = 'get object file input from a p-System volume image (.vol, .dsk); with this or --imd, objectfile is a starting block number, or a name or glob pattern of files in the volume directory, and if it is omitted the directory is listed')
+
+    parser.add_argument('-j', '--jobs', type = int, default = 1, help = 'number of worker processes used to disassemble the segments of a code file')
+
+    add_disassembler_options(parser)
+
+    parser.add_argument('--segment', action = 'append', metavar = 'NAME|NUM', help = 'disassemble only this segment of a code file (may be repeated)')
 
-    parser.add_argument('objectfile', help = 'object file for input')
+    parser.add_argument('--proc', action = 'append', type = int, metavar = 'N', help = 'disassemble only this procedure of each segment (may be repeated)')
+
+    parser.add_argument('--aos-layout', action = 'store_true', help = "decode the segment entries of an AOS code file's index with an assumed layout, since it isn't documented")
+
+    parser.add_argument('--callgraph', metavar = 'FILE', help = 'write the call graph of the code files to FILE, as DOT if its name ends with .dot, otherwise as JSON')
+
+    parser.add_argument('--library', action = 'append', default = [], metavar = 'CODEFILE', help = 'code file, such as SYSTEM.LIBRARY, whose segment names are used to resolve external calls (may be repeated)')
+
+    parser.add_argument('--callers', action = 'append', default = [], metavar = 'SEG.procN', help = 'list the callers of a procedure (may be repeated)')
+
+    parser.add_argument('--callees', action = 'append', default = [], metavar = 'SEG.procN', help = 'list the procedures called by a procedure (may be repeated)')
+
+    parser.add_argument('--stats', metavar = 'FILE', help = 'write a JSON report of the time spent in each phase, the instructions decoded in each segment and procedure, and the opcode histogram to FILE, and a summary to stderr')
+
+    parser.add_argument('--profile', metavar = 'FILE', help = 'run under cProfile, writing the profile to FILE and the most expensive functions to stderr; with --jobs, only the main process is profiled')
+
+    parser.add_argument('--tracemalloc', action = 'store_true', help = 'trace memory allocation, adding the peak and the largest allocation sites to the --stats report')
+
+    parser.add_argument('objectfile', nargs = '?', help = 'object file for input')
 
     parser.add_argument('disfile', type=argparse.FileType('w'), nargs='?', default = sys.stdout, help = 'disassembly output file')
 
     args = parser.parse_args()
 
     print(args)
-    
+
+    try:
+        options = disassembler_options(args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    stats = None
+    if args.stats is not None or args.tracemalloc:
+        stats = Stats()
+        if args.tracemalloc:
+            stats.trace_memory()
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    image = None
     if args.imd is not None:
-        #raise NotImplementedError('This is a stub for future development.')
-        imd = disk.disk(filename = args.imd)
+        try:
+            with stats_phase(stats, 'read'):
+                imd = ImageDisk.open(args.imd)
+        except ValueError as e:
+            parser.error('%s: %s' % (args.imd, e))
+        for s in imd.missing:
+            print('sector unavailable: cylinder %d head %d sector %d' % (s.cylinder, s.head, s.sector))
+        image = imd
+    elif args.volume is not None:
+        image = VolumeImage.open(args.volume)
+
+    volume = None
+    if image is not None:
+        if args.objectfile is None or not args.objectfile.isdigit():
+            try:
+                volume = PSystemVolume(image)
+            except ValueError as e:
+                parser.error('%s: %s' % (args.imd or args.volume, e))
+            if args.objectfile is None:
+                volume.print_directory()
+                sys.exit(0)
+            if args.rom or args.wdboot or args.acdboot:
+                parser.error('boot images must be given by block number')
+        else:
+            block = int(args.objectfile)
+            if args.rom or args.wdboot or args.acdboot:
+                objectfile = io.BytesIO(image.blocks(block))
+            else:
+                objectfile = image.blocks(block)
+    elif args.objectfile is None:
+        parser.error('the objectfile argument is required')
     else:
         objectfile = open(args.objectfile, 'rb')
 
     if args.rom or args.wdboot or args.acdboot:
-        mem_init()
+        dis = Disassembler(stats = stats, **options)
 
         if args.rom:
             base = 0xf400
-            read_image(objectfile, base)
+            dis.read_image(objectfile, base)
             objectfile.close()
-            pass_1_rom(seg_count = 2)
+            dis.pass_1_rom(seg_count = 2)
         elif args.wdboot:
             base = 0x0000
-            read_image(objectfile, base)
+            dis.read_image(objectfile, base)
             objectfile.close()
-            pass_1_wdboot(seg_count = 16)
+            dis.pass_1_wdboot(seg_count = 16)
         elif args.acdboot:
             base = 0x2000
-            read_image(objectfile, base)
-            print("image_base %04x, image_len %04x" % (image_base, image_len))
+            dis.read_image(objectfile, base)
+            print("image_base %04x, image_len %04x" % (dis.image_base, dis.image_len))
             objectfile.close()
-            pass_1_acdboot(seg_count = 2)
+            dis.pass_1_acdboot(seg_count = 2)
 
         if args.disfile is not None:
-            pass_2(args.disfile)
+            out = renderers[args.format](args.disfile)
+            if stats is not None:
+                stats.instrument_renderer(out)
+            dis.pass_2(out)
             args.disfile.close()
     else:
-        dis_codefile(objectfile, args.disfile)
-        objectfile.close()
+        cache = None
+        if args.cache is not None:
+            cache = SegmentCache(args.cache, args.cache_size * 1024 * 1024)
+        callgraph = None
+        if args.callgraph or args.callers or args.callees:
+            try:
+                callgraph = CallGraph([CodeFile.open(library) for library in args.library])
+            except (OSError, ValueError) as e:
+                parser.error(str(e))
+        try:
+            if volume is not None:
+                dis_volume(volume, [args.objectfile], args.disfile, jobs = max(1, args.jobs), format = args.format,
+                           options = options, segments = args.segment, procs = args.proc, cache = cache,
+                           callgraph = callgraph, stats = stats, aos_layout = args.aos_layout)
+            else:
+                dis_codefile(objectfile, args.disfile, jobs = max(1, args.jobs), format = args.format, options = options,
+                             segments = args.segment, procs = args.proc, cache = cache, callgraph = callgraph,
+                             stats = stats, aos_layout = args.aos_layout)
+        except (KeyError, ValueError) as e:
+            parser.error(e.args[0])
+        if image is None:
+            objectfile.close()
+        for name in args.callers:
+            node = callgraph.find_node(name)
+            print('callers of %s: %s' % (node, ' '.join(callgraph.callers(node))))
+        for name in args.callees:
+            node = callgraph.find_node(name)
+            print('callees of %s: %s' % (node, ' '.join(callgraph.callees(node))))
+        if args.callgraph:
+            with open(args.callgraph, 'w') as f:
+                if args.callgraph.endswith('.dot'):
+                    callgraph.write_dot(f)
+                else:
+                    callgraph.write_json(f)
         args.disfile.close()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler, stream = sys.stderr).sort_stats('cumulative').print_stats(15)
+    if stats is not None:
+        if args.tracemalloc:
+            stats.stop_tracing_memory()
+        stats.summary(sys.stderr)
+        if args.stats is not None:
+            with open(args.stats, 'w') as f:
+                stats.write_json(f)
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+
+# Generator of synthetic UCSD p-system release III.0 code files, for
+# testing and benchmarking pdis
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The code files are structurally valid: each segment has a procedure
+# dictionary, every procedure has its end offset and local size words,
+# branches land on instruction boundaries within their procedure, and
+# xjp operands point at case tables placed after the procedure's code.
+# The instructions themselves are drawn at random from optab, so they
+# don't compute anything meaningful.
+#
+# Files with more than 16 segments are vectored: block 0 holds the
+# directory entries of the first 16 segments, and the rest follow in
+# directory pages of 16 entries after the last code block.  User code
+# files number their segments from 128 rather than 0.
+
+import argparse
+import collections
+import fnmatch
+import functools
+import random
+import struct
+
+from pdis import optab
+
+GenParams = collections.namedtuple('GenParams', ['segments',        # number of code segments
+                                                 'procs',           # maximum procedures per segment
+                                                 'insts',           # maximum instructions per procedure
+                                                 'branch_density',  # fraction of instructions that branch
+                                                 'case_density',    # fraction that are xjp
+                                                 'gap_words',       # maximum words of data between procedures
+                                                 'interface',       # whether some segments are units with interface text
+                                                 'first_seg',       # number of the first segment, 0 or 128 for a user file
+                                                 'vectored',        # whether to write a vectored file even with 16 segments or less
+                                                 'weights'])        # (mnemonic pattern, weight) pairs for the other instructions, or None
+
+default_params = GenParams(segments = 8,
+                           procs = 10,
+                           insts = 200,
+                           branch_density = 0.1,
+                           case_density = 0.03,
+                           gap_words = 6,
+                           interface = True,
+                           first_seg = 0,
+                           vectored = False,
+                           weights = None)
+
+branch_ops = [op for op in optab if optab[op][0] in ('ujp', 'ujpl', 'efj', 'nfj', 'fjp', 'fjpl')]
+case_ops = [op for op in optab if optab[op][0] == 'xjp']
+other_ops = [op for op in optab if op not in branch_ops and op not in case_ops]
+
+# Returns the instructions other than branches and xjp, with their
+# cumulative weights.  Each instruction has a weight of 1, unless its
+# mnemonic matches a pattern in weights, in which case the last matching
+# pattern gives its weight; a weight of 0 leaves it out.
+@functools.lru_cache()
+def op_mix(weights):
+    ops = []
+    cum_weights = []
+    total = 0
+    for op in other_ops:
+        w = 1
+        for pattern, pw in weights:
+            if fnmatch.fnmatchcase(optab[op][0], pattern.lower()):
+                w = pw
+        if w > 0:
+            total += w
+            ops.append(op)
+            cum_weights.append(total)
+    if not ops:
+        raise ValueError('the opcode weights leave no instructions to generate')
+    return ops, cum_weights
+
+# the "big" operand encoding: one byte below 128, otherwise two bytes
+# with the high bit of the first set
+def encode_big(v):
+    if v < 128:
+        return [v]
+    return [0x80 | (v >> 8), v & 0xff]
+
+# Returns a list of [bytes, fixup] for the instructions of a procedure,
+# where fixup is None or (kind, position) of an operand to be filled in
+# once the procedure has been laid out.
+def gen_insts(rng, count, params):
+    insts = []
+    for i in range(count):
+        r = rng.random()
+        if r < params.branch_density:
+            op = rng.choice(branch_ops)
+        elif r < params.branch_density + params.case_density:
+            op = rng.choice(case_ops)
+        elif params.weights is None:
+            op = rng.choice(other_ops)
+        else:
+            ops, cum_weights = op_mix(params.weights)
+            op = rng.choices(ops, cum_weights = cum_weights)[0]
+        spec = optab[op]
+        b = [op]
+        fixup = None
+        for item in spec[1:]:
+            if item == 'b':
+                if 'case' in spec:
+                    b += [0x80, 0]
+                    fixup = ('case', len(b) - 2)
+                else:
+                    b += encode_big(rng.choice([rng.randrange(128), rng.randrange(32768)]))
+            elif item == 'w':
+                if 'code' in spec:
+                    b += [0, 0]
+                    fixup = ('w', len(b) - 2)
+                else:
+                    b += list(struct.pack('<H', rng.randrange(65536)))
+            elif item in ('ub', 'db'):
+                b.append(rng.randrange(256))
+            elif item == 'sb':
+                b.append(0)
+                fixup = ('sb', len(b) - 1)
+        insts.append([b, fixup])
+    return insts
+
+def code_words(insts):
+    code = []
+    for b, fixup in insts:
+        code += b
+    if len(code) & 1:
+        code.append(0)
+    return [code[i] | (code[i + 1] << 8) for i in range(0, len(code), 2)]
+
+# Append a procedure to words, returning its offset.
+def gen_proc(rng, words, params):
+    po = len(words) + 1
+    start = (po + 1) * 2
+    insts = gen_insts(rng, rng.randrange(1, params.insts + 1), params)
+    offsets = []
+    o = start
+    for b, fixup in insts:
+        offsets.append(o)
+        o += len(b)
+    end_offset = o - 1
+
+    tables = []
+    for i, (b, fixup) in enumerate(insts):
+        if fixup is None:
+            continue
+        kind, pos = fixup
+        next_offset = offsets[i] + len(b)
+        if kind == 'sb':
+            t = rng.choice([x for x in offsets if -128 <= x - next_offset <= 127])
+            b[pos] = (t - next_offset) & 0xff
+        elif kind == 'w':
+            t = rng.choice(offsets)
+            b[pos : pos + 2] = list(struct.pack('<H', (t - next_offset) & 0xffff))
+        elif kind == 'case':
+            forward = [x for x in offsets if x >= next_offset] or [next_offset]
+            first = rng.randrange(0, 5)
+            count = rng.randrange(1, 6)
+            tables.append((b, pos, first, [rng.choice(forward) - next_offset for j in range(count)]))
+
+    # the case tables follow the code, so the xjp operands can only be
+    # filled in once the length of the code is known
+    table_offset = po + 1 + len(code_words(insts))
+    for b, pos, first, entries in tables:
+        b[pos] = 0x80 | (table_offset >> 8)
+        b[pos + 1] = table_offset & 0xff
+        table_offset += 2 + len(entries)
+
+    words += [end_offset, rng.randrange(20)]
+    words += code_words(insts)
+    for b, pos, first, entries in tables:
+        words += [first, first + len(entries) - 1] + entries
+    return po
+
+# Returns the words of a code segment.
+def gen_segment(rng, seg_num, num_procs, params):
+    words = [0]
+    proc_offsets = {}
+    order = list(range(1, num_procs + 1))
+    rng.shuffle(order)
+    for p in order:
+        if params.gap_words and rng.random() < 0.5:
+            value = rng.choice([0, 0, rng.randrange(65536)])
+            words += [value] * rng.randrange(1, params.gap_words + 1)
+        proc_offsets[p] = gen_proc(rng, words, params)
+    if params.gap_words:
+        words += [0] * rng.randrange(0, params.gap_words)
+    proc_dir = len(words) + num_procs
+    for i in range(num_procs, 0, -1):
+        words.append(proc_offsets[i])
+    words.append((seg_num & 0xff) | (num_procs << 8))
+    words[0] = proc_dir
+    return words
+
+# Returns the contents of a code file.
+def gen_codefile(rng, params = default_params):
+    vectored = params.vectored or params.segments > 16
+    if params.first_seg not in (0, 128) or params.first_seg + params.segments > 256:
+        raise ValueError('segment numbers must be 0..255, or 128..255 for a user code file')
+    pages = [bytearray(512) for i in range(max(1, (params.segments + 15) // 16))]
+    body = bytearray()
+    block = 1
+    for s in range(params.segments):
+        page = pages[s // 16]
+        seg_num = params.first_seg + s
+        rel = s % 16
+        kind = 0
+        addr = 0
+        if params.interface and s % 3 == 1:
+            # unit with interface text
+            kind = 3
+            addr = block
+            count = rng.randrange(1, 3)
+            body += bytes(rng.randrange(32, 127) for i in range(512 * count))
+            block += count
+        words = gen_segment(rng, seg_num, rng.randrange(1, params.procs + 1), params)
+        struct.pack_into('<HH', page, rel * 4, block, len(words))
+        name = 'SEG%d' % seg_num if s % 5 else ''
+        page[0x40 + rel * 8 : 0x48 + rel * 8] = name.ljust(8).encode('ascii')
+        struct.pack_into('<H', page, 0xc0 + rel * 2, kind)
+        struct.pack_into('<H', page, 0xe0 + rel * 2, addr)
+        page[0x100 + rel * 2] = seg_num
+        page[0x101 + rel * 2] = 3
+        data = struct.pack('<%dH' % len(words), *words)
+        count = (len(words) + 255) // 256
+        body += data + bytes(count * 512 - len(data))
+        block += count
+    if not vectored:
+        return bytes(pages[0] + body)
+    # the directory pages after the first follow the last code block
+    pages[0][0x16f] = 1
+    struct.pack_into('<HH', pages[0], 0x170, params.first_seg + params.segments - 1, block - 1)
+    return bytes(pages[0] + body + b''.join(pages[1:]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'generate synthetic p-system III.0 code files')
+    parser.add_argument('--seed', type = int, default = 1, help = 'random seed (default: %(default)s)')
+    parser.add_argument('--segments', type = int, default = default_params.segments, help = 'number of code segments; more than 16 makes a vectored code file (default: %(default)s)')
+    parser.add_argument('--procs', type = int, default = default_params.procs, help = 'maximum procedures per segment (default: %(default)s)')
+    parser.add_argument('--insts', type = int, default = default_params.insts, help = 'maximum instructions per procedure (default: %(default)s)')
+    parser.add_argument('--branch-density', type = float, default = default_params.branch_density, help = 'fraction of instructions that are jumps (default: %(default)s)')
+    parser.add_argument('--case-density', type = float, default = default_params.case_density, help = 'fraction of instructions that are xjp with a case table (default: %(default)s)')
+    parser.add_argument('--gap-words', type = int, default = default_params.gap_words, help = 'maximum words of data between procedures (default: %(default)s)')
+    parser.add_argument('--no-interface', action = 'store_true', help = "don't generate unit segments with interface text")
+    parser.add_argument('--user', action = 'store_true', help = 'number the segments from 128, as in a user code file')
+    parser.add_argument('--vectored', action = 'store_true', help = 'write a vectored code file even with 16 segments or less')
+    parser.add_argument('--weight', action = 'append', default = [], metavar = 'MNEMONIC=WEIGHT',
+                        help = 'relative weight of the instructions other than jumps whose mnemonics match the pattern, 0 to leave them out (default: 1 each); may be repeated, the last match applying')
+    parser.add_argument('-n', '--count', type = int, default = 1, help = 'number of code files; with more than one, %%d in the output name is replaced by the file number')
+    parser.add_argument('output', help = 'code file to write')
+    args = parser.parse_args()
+
+    weights = None
+    if args.weight:
+        weights = []
+        for w in args.weight:
+            pattern, sep, value = w.partition('=')
+            try:
+                weights.append((pattern, float(value)))
+            except ValueError:
+                parser.error('bad --weight %s' % w)
+        weights = tuple(weights)
+
+    params = GenParams(segments = args.segments,
+                       procs = args.procs,
+                       insts = args.insts,
+                       branch_density = args.branch_density,
+                       case_density = args.case_density,
+                       gap_words = args.gap_words,
+                       interface = not args.no_interface,
+                       first_seg = 128 if args.user else 0,
+                       vectored = args.vectored,
+                       weights = weights)
+    rng = random.Random(args.seed)
+    for i in range(args.count):
+        name = args.output % i if args.count > 1 else args.output
+        try:
+            data = gen_codefile(rng, params)
+        except ValueError as e:
+            parser.error(e.args[0])
+        with open(name, 'wb') as f:
+            f.write(data)
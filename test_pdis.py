@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+
+# Tests of pdis on synthetic code files from pgen
+# Run with: python3 -m unittest
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import pdis
+import pgen
+
+pdis_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdis.py')
+
+def gen_codefile(seed, **kwargs):
+    params = pgen.default_params._replace(**dict({ 'procs': 3, 'insts': 30 }, **kwargs))
+    return pgen.gen_codefile(random.Random(seed), params)
+
+# Runs pdis on the code file data with the given options, returning its
+# exit status, listing and standard error.
+def run_pdis(data, *options):
+    with tempfile.TemporaryDirectory() as d:
+        code_path = os.path.join(d, 'test.code')
+        out_path = os.path.join(d, 'test.out')
+        with open(code_path, 'wb') as f:
+            f.write(data)
+        p = subprocess.run([sys.executable, pdis_path] + list(options) + [code_path, out_path],
+                           stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True)
+        listing = ''
+        if os.path.exists(out_path):
+            with open(out_path) as f:
+                listing = f.read()
+        return p.returncode, listing, p.stderr
+
+
+class VectoredCodeFileTest(unittest.TestCase):
+    def check_segments(self, data, seg_nums):
+        codefile = pdis.CodeFile(data)
+        self.assertEqual([si.segnum for si in codefile.code_segments()], seg_nums)
+        for si in codefile.code_segments():
+            # the procedure dictionary of each segment holds its number
+            words = pdis.word_view(codefile.segment_data(si))
+            proc_dir = words[0]
+            self.assertEqual(words[proc_dir] & 0xff, si.segnum & 0xff)
+
+    def test_static(self):
+        self.check_segments(gen_codefile(1, segments = 16), list(range(16)))
+
+    def test_many_pages(self):
+        # 40 segments take three directory pages
+        self.check_segments(gen_codefile(2, segments = 40), list(range(40)))
+
+    def test_user(self):
+        self.check_segments(gen_codefile(3, segments = 16, first_seg = 128, vectored = True),
+                            list(range(128, 144)))
+
+    def test_user_many_pages(self):
+        self.check_segments(gen_codefile(4, segments = 50, first_seg = 128),
+                            list(range(128, 178)))
+
+    def test_select_segment(self):
+        for data, spec in [(gen_codefile(5, segments = 40), '33'),
+                           (gen_codefile(6, segments = 40, first_seg = 128), 'SEG161')]:
+            status, listing, err = run_pdis(data, '--segment', spec)
+            self.assertEqual(status, 0, err)
+            seg_name = 'SEG%d' % int(spec.lstrip('SEG'))
+            self.assertEqual(re.findall(r'\s(\S+)\.procdir$', listing, re.M), [seg_name])
+
+    def test_truncated(self):
+        data = gen_codefile(7, segments = 40)
+        # drop the last directory page
+        with self.assertRaises(ValueError):
+            pdis.CodeFile(data[:-512])
+        status, listing, err = run_pdis(data[:-512])
+        self.assertEqual(status, 2)
+        self.assertIn('past the end of the code file', err)
+
+    def test_short(self):
+        with self.assertRaises(ValueError):
+            pdis.CodeFile(bytes(300))
+        status, listing, err = run_pdis(bytes(300))
+        self.assertEqual(status, 2)
+        self.assertIn('too short for a segment directory', err)
+
+
+# Decodes the instruction at index pos of code the way the first pdis
+# did, straight from optab, returning its mnemonic, length in bytes and
+# operand values.
+def reference_decode(code, pos):
+    op = pdis.optab.get(code[pos], ('undefined',))
+    p = pos + 1
+    parms = []
+    for item in op[1:]:
+        if isinstance(item, int):
+            parms.append(item)
+        elif item == 'b':
+            parm = code[p]
+            p += 1
+            if parm >= 128:
+                parm = ((parm - 128) << 8) + code[p]
+                p += 1
+            parms.append(parm)
+        elif item == 'w':
+            parms.append(struct.unpack_from('<h', code, p)[0])
+            p += 2
+        elif item in ('ub', 'db'):
+            parms.append(code[p])
+            p += 1
+        elif item == 'sb':
+            parms.append(struct.unpack_from('<b', code, p)[0])
+            p += 1
+    return op[0], p - pos, parms
+
+class ListingTest(unittest.TestCase):
+    # sha256 of the text listing of gen_codefile(11, segments = 6), which
+    # matches the listing of the first pdis but for the label names
+    listing_sha256 = '4536ab2f2f3f0b6fc8af19a76685768a276058adc6af0160d25069e61256be45'
+
+    def test_decode(self):
+        rng = random.Random(10)
+        for opcode in range(256):
+            for i in range(20):
+                code = bytes([opcode] + [rng.randrange(256) for i in range(4)])
+                entry, length, parms = pdis.decode_inst(code, 0)
+                self.assertEqual((entry.mnem, length, list(parms or entry.imm_operands)),
+                                 reference_decode(code, 0))
+
+    def test_listing(self):
+        data = gen_codefile(11, segments = 6)
+        status, listing, err = run_pdis(data)
+        self.assertEqual(status, 0, err)
+        self.assertEqual(hashlib.sha256(listing.encode('utf-8')).hexdigest(), self.listing_sha256)
+
+    def test_labels(self):
+        for seed in range(12, 16):
+            status, listing, err = run_pdis(gen_codefile(seed, procs = 5, insts = 80, case_density = 0.1),
+                                            '--format', 'jsonl')
+            self.assertEqual(status, 0, err)
+            procs = {}
+            for record in map(json.loads, listing.splitlines()):
+                if record['type'] == 'instruction':
+                    procs.setdefault((record['seg_name'], record['proc_name']), []).append(record)
+            self.assertTrue(procs)
+            for (seg_name, proc_name), insts in procs.items():
+                # one label per target, numbered in address order; a case
+                # table may also jump past the last instruction
+                targets = sorted(set(target for inst in insts for target in inst['targets']))
+                labels = { target: '%s.%s.%02x' % (seg_name, proc_name, i) for i, target in enumerate(targets) }
+                self.assertEqual([(inst['byte_offset'], inst['label']) for inst in insts if inst['label']],
+                                 [(inst['byte_offset'], labels[inst['byte_offset']])
+                                  for inst in insts if inst['byte_offset'] in labels])
+                # every reference names the label of its target
+                for inst in insts:
+                    for label in re.findall(r'\s(\S+)\t;', inst['text']):
+                        self.assertEqual([label], [labels[target] for target in inst['targets']])
+
+    def test_jobs_and_cache(self):
+        data = gen_codefile(16, segments = 12, procs = 5, insts = 80)
+        status, listing, err = run_pdis(data)
+        self.assertEqual(status, 0, err)
+        self.assertEqual(run_pdis(data, '-j', '3'), (0, listing, ''))
+        with tempfile.TemporaryDirectory() as d:
+            for run in ('cold', 'warm'):
+                self.assertEqual(run_pdis(data, '--cache', d), (0, listing, ''), run)
+                self.assertTrue(os.listdir(d))
+            self.assertEqual(run_pdis(data, '--cache', d, '-j', '3'), (0, listing, ''))
+
+    def test_csv_fill(self):
+        data = gen_codefile(9, segments = 4, gap_words = 12)
+        status, text, err = run_pdis(data, '--fill', '--fill-min', '2')
+        self.assertEqual(status, 0, err)
+        status, listing, err = run_pdis(data, '--fill', '--fill-min', '2', '--format', 'csv')
+        self.assertEqual(status, 0, err)
+        fills = [(int(row['addr']), int(row['count']), int(row['value']))
+                 for row in csv.DictReader(io.StringIO(listing)) if row['type'] == 'fill']
+        self.assertTrue(fills)
+        self.assertTrue(all(count >= 2 for addr, count, value in fills))
+        self.assertEqual(fills, [(int(start, 16), int(end, 16) + 1 - int(start, 16), int(value, 16))
+                                 for start, end, value in re.findall(r'^(\w{4})-(\w{4}):  (\w{4})  fill', text, re.M)])
+
+
+# Returns an AOS code file holding the given segments, each a (name,
+# words) pair, with one index block, and the entries to go in it, each a
+# (name, block, length) triple, overriding those of the segments if
+# given.  The entries are in the layout pdis assumes with --aos-layout,
+# which isn't known to be that of real AOS code files.
+def aos_codefile(segments, entries = None):
+    index = bytearray(512)
+    index[0:4] = b'\xff\xff\x00\x00'
+    body = bytearray()
+    block = 1
+    layout = []
+    for name, words in segments:
+        layout.append((name, block, len(words)))
+        data = struct.pack('<%dH' % len(words), *words)
+        count = (len(words) + 255) // 256
+        body += data + bytes(count * 512 - len(data))
+        block += count
+    for i, (name, block, length) in enumerate(entries or layout):
+        e = 4 + i * pdis.CodeFile.aos_entry_size
+        index[e : e + 8] = name.ljust(8).encode('ascii')
+        struct.pack_into('<HHHBB', index, e + 8, block, length, 0, i + 1, 3)
+    return bytes(index + body)
+
+class AosCodeFileTest(unittest.TestCase):
+    def segments(self):
+        rng = random.Random(8)
+        params = pgen.default_params._replace(procs = 3, insts = 30)
+        return [('SEG%d' % i, pgen.gen_segment(rng, i, 3, params)) for i in (1, 2)]
+
+    def test_index_blocks(self):
+        # the entries aren't decoded without an explicit opt in
+        data = aos_codefile(self.segments())
+        codefile = pdis.CodeFile(data)
+        self.assertTrue(codefile.aos)
+        self.assertEqual(codefile.index_block_nums, [0])
+        self.assertEqual(codefile.code_segments(), [])
+        status, listing, err = run_pdis(data)
+        self.assertEqual(status, 0, err)
+        self.assertIn('AOS index blocks: 0', listing)
+        self.assertIn('--aos-layout', err)
+        self.assertNotIn('procdir', listing)
+
+    def test_index_chain(self):
+        data = bytearray(aos_codefile(self.segments()))
+        # a second index block, past the segments, which points back
+        # to the first
+        data[2:4] = struct.pack('<H', len(data) // 512)
+        data += b'\xff\xff' + bytes(510)
+        self.assertEqual(pdis.CodeFile(bytes(data)).index_block_nums, [0, len(data) // 512 - 1])
+        data[-510:-508] = struct.pack('<H', len(data) // 512 - 1)
+        with self.assertRaises(ValueError):
+            pdis.CodeFile(bytes(data))
+
+    def test_assumed_layout(self):
+        codefile = pdis.CodeFile(aos_codefile(self.segments()), aos_layout = True)
+        self.assertEqual([(si.name.strip(), si.segnum) for si in codefile.code_segments()],
+                         [('SEG1', 1), ('SEG2', 2)])
+        status, listing, err = run_pdis(aos_codefile(self.segments()), '--aos-layout')
+        self.assertEqual(status, 0, err)
+        self.assertIn('layout of the index entries is assumed', listing)
+        self.assertEqual(re.findall(r'\s(\S+)\.procdir$', listing, re.M), ['SEG1', 'SEG2'])
+
+    def test_bad_entries(self):
+        segments = self.segments()
+        blocks = len(aos_codefile(segments)) // 512
+        for entries in [[('SEG1', 1, 0)],                       # empty
+                        [('SEG1', blocks - 1, 512)],            # past the end of the file
+                        [('SEG1', 1, 512), ('SEG2', 2, 256)]]:  # overlapping
+            with self.assertRaises(ValueError):
+                pdis.CodeFile(aos_codefile(segments, entries), aos_layout = True)
+        status, listing, err = run_pdis(aos_codefile(segments, [('SEG1', blocks - 1, 512)]), '--aos-layout')
+        self.assertEqual(status, 2)
+        self.assertIn('is not within the code file', err)
+
+
+# Returns an ImageDisk image of data, with the given sector size, sectors
+# per track and heads, in which the sectors of each track are stored in
+# a shuffled order and those filled with one byte are compressed.
+def imd_image(data, sector_size = 256, sectors = 8, heads = 2, seed = 1):
+    rng = random.Random(seed)
+    track_size = sector_size * sectors
+    image = bytearray(b'IMD 1.18: test\r\n\x1a')
+    for track in range((len(data) + track_size - 1) // track_size):
+        order = list(range(1, sectors + 1))
+        rng.shuffle(order)
+        image += bytes([3, track // heads, track % heads, sectors, sector_size.bit_length() - 8]) + bytes(order)
+        for sector in order:
+            pos = track * track_size + (sector - 1) * sector_size
+            d = data[pos : pos + sector_size].ljust(sector_size, b'\0')
+            if d == bytes([d[0]]) * sector_size:
+                image += bytes([2, d[0]])
+            else:
+                image += b'\x01' + d
+    return bytes(image)
+
+class ImageDiskTest(unittest.TestCase):
+    def test_blocks(self):
+        data = bytearray(gen_codefile(18, segments = 6))
+        data += bytes(-len(data) % 4096)
+        for sector_size in (128, 256, 512):
+            imd = pdis.ImageDisk(imd_image(data, sector_size))
+            self.assertEqual(imd.missing, [])
+            self.assertEqual(bytes(imd.blocks(0)), bytes(data))
+            for block in range(len(data) // 512):
+                for count in (1, 3):
+                    self.assertEqual(bytes(imd.blocks(block, count)), bytes(data[block * 512 : (block + count) * 512]))
+        # a block in one normal sector isn't copied
+        block = next(i for i in range(len(data) // 512) if len(set(data[i * 512 : i * 512 + 512])) > 1)
+        self.assertIs(imd.blocks(block, 1).obj, imd.buf.obj)
+
+    def test_geometry(self):
+        # three tracks, on two heads, of 8 sectors of 256 bytes, and then
+        # a last track that doesn't match them
+        image = imd_image(bytes(range(256)) * 24, 256, 8)
+        self.assertEqual(len(pdis.ImageDisk(image).blocks(0)), 256 * 24)
+        def track(cylinder, head, sectors, size_code):
+            return bytes([3, cylinder, head, sectors, size_code]) + bytes(range(1, sectors + 1)) + b'\x02\x00' * sectors
+        for last in [track(1, 1, 7, 1),    # a sector short
+                     track(1, 1, 16, 0),   # 128 byte sectors
+                     track(2, 1, 8, 1)]:   # cylinder 1 head 1 missing
+            with self.assertRaises(ValueError):
+                pdis.ImageDisk(image + last)
+        pdis.ImageDisk(image + track(1, 1, 8, 1))
+
+
+class AnalyzeTest(unittest.TestCase):
+    # stands in for a Corpus, which needs NumPy, recording the order in
+    # which results are added
+    class Added(list):
+        def __contains__(self, sha256):
+            return any(r.sha256 == sha256 for r in self)
+
+        def add(self, result):
+            self.append(result)
+
+    def test_input_order(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = []
+            for i in range(8):
+                # the first files are the largest, so they finish last
+                paths.append(os.path.join(d, '%d.code' % i))
+                with open(paths[-1], 'wb') as f:
+                    f.write(gen_codefile(i, segments = 16 - i * 2, procs = 10, insts = 200))
+            added = self.Added()
+            results = pdis.corpus_run(added, paths, pdis.analyze_file, num_jobs = 4)
+            self.assertEqual([r.input for r in results], paths)
+            self.assertEqual([r.input for r in added], paths)
+            self.assertEqual(pdis.corpus_run(added, paths, pdis.analyze_file, num_jobs = 4), [])
+
+
+class SearchIndexTest(unittest.TestCase):
+    def test_long_procedure(self):
+        # a procedure of more than 64K instructions is possible in a
+        # segment of 64K words
+        long_proc = [(i, 'sldc', (i & 31,)) for i in range(70000)] + [(70000, 'ldcn', ()), (70001, 'equpwr', ())]
+        index = pdis.SearchIndex()
+        index.add(pdis.IndexResult('test.code', '0' * 64, 'ok', None,
+                                   [('SEG1', 'proc1', long_proc),
+                                    ('SEG1', 'proc2', [(4, 'ldcn', ()), (5, 'sldc', (5,))])]))
+        self.assertIn('0' * 64, index)
+        self.assertEqual([(h.proc_name, h.byte_offset) for h in index.search('ldcn; equpwr')],
+                         [('proc1', 70000)])
+        self.assertEqual([(h.proc_name, h.byte_offset) for h in index.search('ldcn; sldc 5')],
+                         [('proc2', 4)])
+
+
+class DiffTest(unittest.TestCase):
+    def test_fingerprints(self):
+        # fingerprints made from the bytes are those of the full decode
+        codefile = pdis.CodeFile(gen_codefile(17, segments = 6, procs = 6, insts = 80, case_density = 0.1))
+        fingerprints = { pdis.proc_full_name(proc.seg_name, proc.proc_num):
+                         pdis.proc_fingerprint(proc.insts, proc.local_size, proc.dis.mem)
+                         for proc in pdis.decode_code_file(codefile) }
+        self.assertTrue(fingerprints)
+        self.assertEqual(pdis.code_file_fingerprints(codefile), fingerprints)
+
+
+class SignatureDBTest(unittest.TestCase):
+    def test_long_name(self):
+        # a name longer than 255 bytes is cut at a character boundary
+        name = 'é' * 200
+        fingerprint = bytes(range(16))
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'test.sig')
+            pdis.SignatureDB.write(path, { fingerprint: name })
+            db = pdis.SignatureDB(path)
+            self.assertEqual(db.lookup(fingerprint), 'é' * 127)
+            self.assertIsNone(db.lookup(bytes(16)))
+
+
+if __name__ == '__main__':
+    unittest.main()